@@ -0,0 +1,131 @@
+import os
+import sys
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from database import DB_SUFFIX, BUSY_TIMEOUT, get_db_path, get_chat_ids, checkpoint_hot_tier
+
+# Configurations
+BACKUP_FOLDER = 'backups'
+BACKUP_KEEP = 7  # Number of backups kept for each chat
+
+# Function to open a database file read-only
+def _connect_read_only(path):
+    """Open an existing database file read-only, so that a wrong path is never created as an empty database."""
+    return sqlite3.connect(f'{Path(path).resolve().as_uri()}?mode=ro', uri=True, timeout=BUSY_TIMEOUT)
+
+# Function to check the integrity of a database file
+def check_integrity(path):
+    """Check that a file is an intact SQLite database holding the counts of a chat."""
+    if not os.path.isfile(path):
+        return False
+    try:
+        conn = _connect_read_only(path)
+    except sqlite3.DatabaseError:
+        return False
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()
+        table = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_count'").fetchone()
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conn.close()
+    return result is not None and result[0] == 'ok' and table is not None
+
+# Function to get the backups of a chat
+def get_backups(chat_id):
+    """Get the paths of the backups of a chat, from the oldest to the newest."""
+    if not os.path.exists(BACKUP_FOLDER):
+        return []
+    prefix = f'{chat_id}{DB_SUFFIX[:-3]}_'
+    return sorted(os.path.join(BACKUP_FOLDER, filename) for filename in os.listdir(BACKUP_FOLDER)
+                  if filename.startswith(prefix) and filename.endswith('.db'))
+
+# Function to back up the database of a chat
+def backup_chat(chat_id):
+    """
+    Backs up the database of a chat while the bot is running, with VACUUM INTO on a read connection:
+    in WAL mode it copies a consistent snapshot without blocking the writer, and it is never restarted
+    by the writer's commits. The backup is checked for integrity and only the newest BACKUP_KEEP
+    backups of the chat are kept.
+
+    Args:
+        chat_id (int): ID of the chat.
+
+    Returns:
+        str: The path of the backup.
+    """
+    # A wrong chat ID must not create an empty database
+    if not os.path.isfile(get_db_path(chat_id)):
+        raise FileNotFoundError(f"No database for chat {chat_id}")
+
+    # Include the counts not yet written from memory
+    checkpoint_hot_tier(chat_id)
+
+    os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    path = os.path.join(BACKUP_FOLDER, f'{chat_id}{DB_SUFFIX[:-3]}_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.db')
+
+    # The copy is a single self-contained file in rollback journal mode, which read-only checks open without WAL side files
+    source = _connect_read_only(get_db_path(chat_id))
+    try:
+        source.execute('VACUUM INTO ?', (path,))
+    finally:
+        source.close()
+
+    if not check_integrity(path):
+        os.remove(path)
+        raise sqlite3.DatabaseError(f"Backup of chat {chat_id} failed the integrity check")
+
+    # Rotate the backups
+    for old_path in get_backups(chat_id)[:-BACKUP_KEEP]:
+        os.remove(old_path)
+
+    return path
+
+# Function to restore the database of a chat
+def restore_chat(chat_id, path=None):
+    """
+    Restores the database of a chat from a backup, the newest one if path is None.
+    The bot should be stopped, since its caches are not aware of the restore.
+
+    Args:
+        chat_id (int): ID of the chat.
+        path (str): Path of the backup.
+
+    Returns:
+        str: The path of the restored backup.
+    """
+    if path is None:
+        backups = get_backups(chat_id)
+        if not backups:
+            raise FileNotFoundError(f"No backups of chat {chat_id}")
+        path = backups[-1]
+    if not check_integrity(path):
+        raise sqlite3.DatabaseError(f"Backup {path} failed the integrity check")
+
+    source = _connect_read_only(path)
+    target = sqlite3.connect(get_db_path(chat_id), timeout=BUSY_TIMEOUT)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+    return path
+
+if __name__ == '__main__':
+    usage = ("Usage:\n"
+             "  python3 backup.py backup [CHAT_ID]         Back up a chat, or all of them\n"
+             "  python3 backup.py restore CHAT_ID [FILE]   Restore a chat from a backup, the newest if FILE is not given\n"
+             "  python3 backup.py check FILE               Check the integrity of a backup")
+    args = sys.argv[1:]
+    if args[:1] == ['backup'] and len(args) <= 2:
+        for chat_id in (args[1:] or get_chat_ids()):
+            print(f"Chat {chat_id}: {backup_chat(chat_id)}")
+    elif args[:1] == ['restore'] and len(args) in (2, 3):
+        print(f"Chat {args[1]} restored from {restore_chat(args[1], args[2] if len(args) == 3 else None)}")
+    elif args[:1] == ['check'] and len(args) == 2:
+        print("ok" if check_integrity(args[1]) else "corrupted")
+    else:
+        print(usage)
+        sys.exit(1)
@@ -1,12 +1,18 @@
 import os
+import re
+import asyncio
 import logging
+from collections import Counter, defaultdict
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, time, timedelta
 import pytz
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from database import STORING_FORMAT, DISPLAY_FORMAT, CHARTS_FOLDER, init_database, get_count, update_count, get_rank, get_statistics, get_record, get_constipation_days
-from utils import generate_table_and_chart, analyze_user_record
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
+from database import STORING_FORMAT, DISPLAY_FORMAT, init_database, get_count, update_count, get_rank, get_statistics, get_record, get_constipation_days, get_global_rank, get_chat_ids, add_counts, archive_closed_years, cached_call, get_query_cache_stats, get_period_version, get_range_rank, enable_hot_tier, checkpoint_hot_tier, set_owned_chats
+from dispatcher import route_chat, run_dispatcher, webhook_updates, WEBHOOK_PORT
+from backup import backup_chat
+from utils import generate_table_and_chart, analyze_user_record, get_chart_path, precompute_period, get_precomputed, normalize_period_date, parse_dates, split_message
 
 # Enable logging
 log_filename = "caccometro.log"
@@ -24,6 +30,102 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 BOT_USERNAME = os.environ.get('BOT_USERNAME')
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+GLOBAL_RANK_CACHE_SECONDS = int(os.environ.get('GLOBAL_RANK_CACHE_SECONDS', 300))
+GLOBAL_RANK_TOP_K = int(os.environ.get('GLOBAL_RANK_TOP_K', 10))
+PRECOMPUTE_TIME = os.environ.get('PRECOMPUTE_TIME', '03:00')  # Europe/Rome time of the monthly precomputation
+ARCHIVE_TIME = os.environ.get('ARCHIVE_TIME', '04:00')  # Europe/Rome time of the monthly archival of the closed years
+BACKUP_TIME = os.environ.get('BACKUP_TIME', '05:00')  # Europe/Rome time of the daily backups
+CATCH_UP = os.environ.get('CATCH_UP', 'true').lower() == 'true'  # Count the 💩 sent while the bot was down
+STATS_INTERVAL = int(os.environ.get('STATS_INTERVAL', 3600))  # Seconds between the logs of the message filter and query cache counters
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 16))  # Updates of different chats processed at the same time, 1 to disable
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 0))  # Number of worker processes, 0 to handle everything in this process
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL')  # Alternative Bot API server, e.g. a local one for testing
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public HTTPS URL receiving the updates with BOT_WORKERS, None to use polling
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', WEBHOOK_PORT))  # Local port the webhook listens on, behind the proxy of WEBHOOK_URL
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')  # Secret token checked on every webhook request
+TIERED_STORAGE = os.environ.get('TIERED_STORAGE', 'false').lower() == 'true'  # Keep the current month of the active chats in memory
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 60))  # Seconds between two writes of the in-memory counts to disk
+
+# Update processor
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Update processor handling the updates of different chats concurrently, while keeping the updates of each chat in order."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [lock, number of updates holding or waiting for it]
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # The lock is taken before the concurrency slot: updates queue up in arrival order
+        # and the slots are only used by updates that can run
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Telegram file_id of the charts already uploaded: (chat_id, time_period, date) -> (period version, file_id)
+chart_file_ids = {}
+
+# Message filters
+class TriggerFilter(filters.MessageFilter):
+    """Filter letting through only the messages handle_message reacts to, counting the dropped ones."""
+
+    def __init__(self):
+        super().__init__(name='TriggerFilter')
+        # Case insensitive superset of the checks done by handle_message: 💩, bot mention and "run"
+        triggers = ["💩", "run"] + ([re.escape(BOT_USERNAME)] if BOT_USERNAME else [])
+        self.pattern = re.compile('|'.join(triggers), re.IGNORECASE)
+        self.counters = {'accepted': 0, 'dropped': 0}
+
+    def filter(self, message):
+        if message.text and self.pattern.search(message.text):
+            self.counters['accepted'] += 1
+            return True
+        self.counters['dropped'] += 1
+        return False
+
+TRIGGERS = TriggerFilter()
+
+# Function to send the chart of a period
+async def reply_chart(update: Update, rank, time_period, date, artifacts):
+    """Send the chart of the period, resending the previous upload by file_id if the counts of the period did not change."""
+    chat_id = update.message.chat_id
+    key = (chat_id, time_period, normalize_period_date(time_period, date))
+    version = get_period_version(chat_id, time_period, date)
+
+    uploaded = chart_file_ids.get(key)
+    if uploaded and uploaded[0] == version:
+        try:
+            await update.message.reply_photo(uploaded[1])
+            return
+        except BadRequest:
+            pass  # The file_id is no longer valid, upload it again
+
+    if not artifacts:
+        # Render in a worker thread, so that the other chats are served in the meantime
+        await asyncio.to_thread(generate_table_and_chart, rank, chat_id, time_period, date)
+
+    with open(get_chart_path(chat_id, time_period, date), 'rb') as chart:
+        message = await update.message.reply_photo(chart)
+    chart_file_ids[key] = (version, message.photo[-1].file_id)
 
 # Command handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -32,6 +134,21 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Ciao, sono 🤖 *Caccometro* 🤖.\n"
                                     "Manda 💩 quando hai fatto il tuo dovere.", parse_mode='Markdown')
 
+# Function to build the message of a rank
+def format_rank(title, rank):
+    """Format a rank as a message, with medals for the first three users."""
+    message = f"Ecco la *{title}*:\n"
+    for i, (username, total_count) in enumerate(rank, start=1):
+        if i == 1:
+            message += f"🥇 *@{username}*: {total_count}\n"
+        elif i == 2:
+            message += f"🥈 *@{username}*: {total_count}\n"
+        elif i == 3:
+            message += f"🥉 *@{username}*: {total_count}\n"
+        else:
+            message += f"{i}. @{username}: {total_count}\n"
+    return message
+
 async def classifica_mese_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /classifica_mese command."""
     args = context.args
@@ -46,29 +163,15 @@ async def classifica_mese_command(update: Update, context: ContextTypes.DEFAULT_
         now = datetime.now(pytz.timezone('Europe/Rome'))
         date = now.strftime("%m-%Y")
 
-    rank = get_rank(update.message.chat_id, 'month', date)
+    artifacts = get_precomputed(update.message.chat_id, 'month', date)
+    rank = artifacts['rank'] if artifacts else get_rank(update.message.chat_id, 'month', date)
     if not rank:
         await update.message.reply_text(f"Nel mese {date} non sono state contate 💩.")
         return
 
-    message = f"Ecco la *classifica del mese {date}*:\n"
-    for i, (username, total_count) in enumerate(rank, start=1):
-        if i == 1:
-            message += f"🥇 *@{username}*: {total_count}\n"
-        elif i == 2:
-            message += f"🥈 *@{username}*: {total_count}\n"
-        elif i == 3:
-            message += f"🥉 *@{username}*: {total_count}\n"
-        else:
-            message += f"{i}. @{username}: {total_count}\n"
-
-    generate_table_and_chart(rank, update.message.chat_id, 'month', date)
-
-    date_parts = date.split('-')
-    saving_date = f"{date_parts[1]}_{date_parts[0]}"
+    message = format_rank(f"classifica del mese {date}", rank)
 
-    with open(os.path.join(CHARTS_FOLDER, f'{update.message.chat_id}_{saving_date}.png'), 'rb') as chart:
-        await update.message.reply_photo(chart)
+    await reply_chart(update, rank, 'month', date, artifacts)
 
     await update.message.reply_text(message, parse_mode='Markdown')
 
@@ -81,29 +184,128 @@ async def classifica_anno_command(update: Update, context: ContextTypes.DEFAULT_
         now = datetime.now(pytz.timezone('Europe/Rome'))
         year = now.strftime("%Y")
 
-    rank = get_rank(update.message.chat_id, 'year', year)
+    artifacts = get_precomputed(update.message.chat_id, 'year', year)
+    rank = artifacts['rank'] if artifacts else get_rank(update.message.chat_id, 'year', year)
     if not rank:
         await update.message.reply_text(f'Nell\'anno {year} non sono state contate 💩.')
         return
 
-    message = f"Ecco la *classifica dell\'anno {year}*:\n"
-    for i, (username, total_count) in enumerate(rank, start=1):
-        if i == 1:
-            message += f"🥇 *@{username}*: {total_count}\n"
-        elif i == 2:
-            message += f"🥈 *@{username}*: {total_count}\n"
-        elif i == 3:
-            message += f"🥉 *@{username}*: {total_count}\n"
-        else:
-            message += f"{i}. @{username}: {total_count}\n"
+    message = format_rank(f"classifica dell'anno {year}", rank)
 
-    generate_table_and_chart(rank, update.message.chat_id, 'year', year)
-
-    with open(os.path.join(CHARTS_FOLDER, f'{update.message.chat_id}_{year}.png'), 'rb') as chart:
-        await update.message.reply_photo(chart)
+    await reply_chart(update, rank, 'year', year, artifacts)
 
     await update.message.reply_text(message, parse_mode='Markdown')
 
+async def classifica_globale_mese_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /classifica_globale_mese command."""
+    args = context.args
+    if args:
+        try:
+            month, year = args[0].split('-')
+            date = f"{month}-{year}"
+        except ValueError:
+            await update.message.reply_text("Formato data non valido. Usa MM-YYYY.")
+            return
+    else:
+        now = datetime.now(pytz.timezone('Europe/Rome'))
+        date = now.strftime("%m-%Y")
+
+    # Scan the chats in a worker thread, so that the other chats are served in the meantime
+    try:
+        rank = await asyncio.to_thread(get_global_rank, 'month', date, GLOBAL_RANK_TOP_K, GLOBAL_RANK_CACHE_SECONDS)
+    except ValueError:
+        await update.message.reply_text("Formato data non valido. Usa MM-YYYY.")
+        return
+    if not rank:
+        await update.message.reply_text(f"Nel mese {date} non sono state contate 💩 in nessuna chat.")
+        return
+
+    await update.message.reply_text(format_rank(f"classifica globale del mese {date}", rank), parse_mode='Markdown')
+
+async def classifica_globale_anno_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /classifica_globale_anno command."""
+    args = context.args
+    if args:
+        year = args[0]
+    else:
+        now = datetime.now(pytz.timezone('Europe/Rome'))
+        year = now.strftime("%Y")
+
+    # Scan the chats in a worker thread, so that the other chats are served in the meantime
+    try:
+        rank = await asyncio.to_thread(get_global_rank, 'year', year, GLOBAL_RANK_TOP_K, GLOBAL_RANK_CACHE_SECONDS)
+    except ValueError:
+        await update.message.reply_text("Formato data non valido. Usa YYYY.")
+        return
+    if not rank:
+        await update.message.reply_text(f'Nell\'anno {year} non sono state contate 💩 in nessuna chat.')
+        return
+
+    await update.message.reply_text(format_rank(f"classifica globale dell'anno {year}", rank), parse_mode='Markdown')
+
+async def classifica_giorni_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /classifica_giorni command."""
+    args = context.args
+    try:
+        days = int(args[0]) if args else 7
+        if days < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Formato non valido. Usa: /classifica_giorni N")
+        return
+
+    today = datetime.now(pytz.timezone('Europe/Rome'))
+    # Huge N would go before the first day of the calendar, where everything is already counted
+    start_date = datetime.fromordinal(max(1, today.toordinal() - days + 1)).date().isoformat()
+    rank = await asyncio.to_thread(get_range_rank, update.message.chat_id, start_date, today.strftime(STORING_FORMAT))
+    if not rank:
+        await update.message.reply_text(f"Negli ultimi {days} giorni non sono state contate 💩.")
+        return
+
+    await update.message.reply_text(format_rank(f"classifica degli ultimi {days} giorni", rank), parse_mode='Markdown')
+
+async def classifica_periodo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /classifica_periodo command."""
+    args = context.args
+    try:
+        start, end = args[0].split(':')
+        start_date = datetime.strptime(start, DISPLAY_FORMAT).strftime(STORING_FORMAT)
+        end_date = datetime.strptime(end, DISPLAY_FORMAT).strftime(STORING_FORMAT)
+        if start_date > end_date:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("Formato non valido. Usa: /classifica_periodo DD-MM-YYYY:DD-MM-YYYY")
+        return
+
+    rank = await asyncio.to_thread(get_range_rank, update.message.chat_id, start_date, end_date)
+    if not rank:
+        await update.message.reply_text(f"Dal {start} al {end} non sono state contate 💩.")
+        return
+
+    await update.message.reply_text(format_rank(f"classifica dal {start} al {end}", rank), parse_mode='Markdown')
+
+async def classifica_settimana_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /classifica_settimana command."""
+    args = context.args
+    if args:
+        try:
+            week, year = args[0].split('-')
+            monday = datetime.strptime(f'{year}-W{int(week):02}-1', '%G-W%V-%u')
+        except ValueError:
+            await update.message.reply_text("Formato data non valido. Usa WW-YYYY.")
+            return
+    else:
+        now = datetime.now(pytz.timezone('Europe/Rome'))
+        monday = (now - timedelta(days=now.weekday())).replace(tzinfo=None)
+    week = monday.strftime('%V-%G')
+
+    rank = await asyncio.to_thread(get_range_rank, update.message.chat_id, monday.strftime(STORING_FORMAT), (monday + timedelta(days=6)).strftime(STORING_FORMAT))
+    if not rank:
+        await update.message.reply_text(f"Nella settimana {week} non sono state contate 💩.")
+        return
+
+    await update.message.reply_text(format_rank(f"classifica della settimana {week}", rank), parse_mode='Markdown')
+
 async def statistiche_mese_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /statistiche_mese command."""
     args = context.args
@@ -118,7 +320,8 @@ async def statistiche_mese_command(update: Update, context: ContextTypes.DEFAULT
         now = datetime.now(pytz.timezone('Europe/Rome'))
         date = now.strftime("%m-%Y")
 
-    statistics = get_statistics(update.message.chat_id, 'month', date)
+    artifacts = get_precomputed(update.message.chat_id, 'month', date)
+    statistics = artifacts['statistics'] if artifacts else get_statistics(update.message.chat_id, 'month', date)
     if not statistics:
         await update.message.reply_text(f"Nessuna statistica disponibile per il mese {date}.")
         return
@@ -145,7 +348,8 @@ async def statistiche_anno_command(update: Update, context: ContextTypes.DEFAULT
         now = datetime.now(pytz.timezone('Europe/Rome'))
         year = now.strftime("%Y")
 
-    statistics = get_statistics(update.message.chat_id, 'year', year)
+    artifacts = get_precomputed(update.message.chat_id, 'year', year)
+    statistics = artifacts['statistics'] if artifacts else get_statistics(update.message.chat_id, 'year', year)
     if not statistics:
         await update.message.reply_text(f"Nessuna statistica disponibile per l\'anno {year}.")
         return
@@ -178,7 +382,7 @@ async def record_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Nessun dato disponibile per @{username}.")
         return
     
-    record_data = analyze_user_record(rows)
+    record_data = cached_call(chat_id, 'analyze_user_record', (username,), lambda: analyze_user_record(rows))
     
     message = (
         f"📊 *Record per @{username}* 📊\n\n"
@@ -192,93 +396,91 @@ async def record_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
+async def parse_backfill_args(update: Update, args, command):
+    """Parse the arguments of /aggiungi and /togli, replying with the error if they are not valid, and return the username and the dates."""
+    usage = f"Formato non valido. Usa: /{command} @username DD-MM-YYYY [DD-MM-YYYY:DD-MM-YYYY ...]"
+    if not args or (args[0].startswith('@') and len(args) == 1):
+        await update.message.reply_text(usage)
+        return None
+
+    if args[0].startswith('@'):
+        username = args[0][1:]
+        specs = args[1:]
+    else:
+        username = update.message.from_user.username
+        specs = args
+
+    try:
+        dates = parse_dates(specs)
+    except ValueError as e:
+        await update.message.reply_text(f"Errore: {str(e)}")
+        return None
+
+    return username, dates
+
 async def aggiungi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /aggiungi command."""
-    args = context.args
-    
-    if len(args) != 1 and len(args) != 2:
-        await update.message.reply_text("Formato non valido. Usa: /aggiungi @username DD-MM-YYYY")
+    parsed = await parse_backfill_args(update, context.args, 'aggiungi')
+    if parsed is None:
         return
-    
-    if len(args) == 1:
-        try:
-            username = update.message.from_user.username
-            date = args[0]
-            parsed_date = datetime.strptime(date, DISPLAY_FORMAT)
-            selected_date = parsed_date.strftime(STORING_FORMAT)
-            today = datetime.now(pytz.timezone('Europe/Rome')).strftime(STORING_FORMAT)
-            if selected_date > today:
-                raise ValueError("La data selezionata è nel futuro.")
-        except ValueError as e:
-            await update.message.reply_text(f"Errore: {str(e)}")
-            return
-    
-    if len(args) == 2:
-        if not args[0].startswith('@'):
-            await update.message.reply_text("Formato non valido. Usa: /aggiungi @username DD-MM-YYYY")
-            return
-        try:
-            username = args[0][1:]
-            date = args[1]
-            parsed_date = datetime.strptime(date, DISPLAY_FORMAT)
-            selected_date = parsed_date.strftime(STORING_FORMAT)
-            today = datetime.now(pytz.timezone('Europe/Rome')).strftime(STORING_FORMAT)
-            if selected_date > today:
-                raise ValueError("La data selezionata è nel futuro.")
-        except ValueError as e:
-            await update.message.reply_text(f"Errore: {str(e)}")
-            return
+    username, dates = parsed
 
-    count = get_count(username, selected_date, update.message.chat_id)
-    update_count(username, selected_date, count + 1, update.message.chat_id)
-    await update.message.reply_text(
-        f"Il conteggio di @{username} nel giorno {date} è stato aggiornato a {count + 1} 💩.")
+    # All the days are updated in a single transaction
+    increments = Counter(dates)
+    changes = add_counts(update.message.chat_id, {(username, date): count for date, count in increments.items()})
+
+    if len(changes) == 1:
+        (_, date), (_, new_count) = next(iter(changes.items()))
+        await update.message.reply_text(
+            f"Il conteggio di @{username} nel giorno {datetime.strptime(date, STORING_FORMAT).strftime(DISPLAY_FORMAT)} è stato aggiornato a {new_count} 💩.")
+        return
+
+    lines = [f"Il conteggio di @{username} è stato aggiornato in {len(changes)} giorni:"]
+    for (_, date), (_, new_count) in sorted(changes.items()):
+        lines.append(f"{datetime.strptime(date, STORING_FORMAT).strftime(DISPLAY_FORMAT)}: {new_count} 💩")
+    # Long lists of days are split over several messages
+    for message in split_message(lines):
+        await update.message.reply_text(message)
 
 async def togli_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /togli command."""
-    args = context.args
-    
-    if len(args) != 1 and len(args) != 2:
-        await update.message.reply_text("Formato non valido. Usa: /togli @username DD-MM-YYYY")
+    parsed = await parse_backfill_args(update, context.args, 'togli')
+    if parsed is None:
+        return
+    username, dates = parsed
+
+    # All the days are updated in a single transaction, counts never go below 0
+    decrements = Counter(dates)
+    changes = add_counts(update.message.chat_id, {(username, date): -count for date, count in decrements.items()})
+
+    if len(changes) == 1:
+        (_, date), (old_count, new_count) = next(iter(changes.items()))
+        date = datetime.strptime(date, STORING_FORMAT).strftime(DISPLAY_FORMAT)
+        if old_count > 0:
+            await update.message.reply_text(
+                f"Il conteggio di @{username} nel giorno {date} è stato aggiornato a {new_count} 💩.")
+        else:
+            await update.message.reply_text(
+                f"Il conteggio di @{username} nel giorno {date} non può essere aggiornato poiché era già 0 💩.")
         return
-    
-    if len(args) == 1:
-        try:
-            username = update.message.from_user.username
-            date = args[0]
-            parsed_date = datetime.strptime(date, DISPLAY_FORMAT)
-            selected_date = parsed_date.strftime(STORING_FORMAT)
-            today = datetime.now(pytz.timezone('Europe/Rome')).strftime(STORING_FORMAT)
-            if selected_date > today:
-                raise ValueError("La data selezionata è nel futuro.")
-        except ValueError as e:
-            await update.message.reply_text(f"Errore: {str(e)}")
-            return
-    
-    if len(args) == 2:
-        if not args[0].startswith('@'):
-            await update.message.reply_text("Formato non valido. Usa: /togli @username DD-MM-YYYY")
-            return
-        try:
-            username = args[0][1:]
-            date = args[1]
-            parsed_date = datetime.strptime(date, DISPLAY_FORMAT)
-            selected_date = parsed_date.strftime(STORING_FORMAT)
-            today = datetime.now(pytz.timezone('Europe/Rome')).strftime(STORING_FORMAT)
-            if selected_date > today:
-                raise ValueError("La data selezionata è nel futuro.")
-        except ValueError as e:
-            await update.message.reply_text(f"Errore: {str(e)}")
-            return
 
-    count = get_count(username, selected_date, update.message.chat_id)
-    if count > 0:
-        update_count(username, selected_date, count - 1, update.message.chat_id)
-        await update.message.reply_text(
-            f"Il conteggio di @{username} nel giorno {date} è stato aggiornato a {count - 1} 💩.")
-    else:
-        await update.message.reply_text(
-            f"Il conteggio di @{username} nel giorno {date} non può essere aggiornato poiché era già 0 💩.")
+    updated = []
+    unchanged = []
+    for (_, date), (old_count, new_count) in sorted(changes.items()):
+        date = datetime.strptime(date, STORING_FORMAT).strftime(DISPLAY_FORMAT)
+        if old_count > 0:
+            updated.append(f"{date}: {new_count} 💩")
+        else:
+            unchanged.append(date)
+
+    lines = [f"Il conteggio di @{username} è stato aggiornato in {len(updated)} {'giorni' if len(updated) != 1 else 'giorno'}" + (":" if updated else ".")]
+    lines += updated
+    if unchanged:
+        lines.append("Non aggiornati poiché erano già a 0 💩:")
+        lines += unchanged
+    # Long lists of days are split over several messages
+    for message in split_message(lines):
+        await update.message.reply_text(message)
 
 async def conto_giorno_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /conto_giorno command."""
@@ -372,8 +574,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         today = datetime.now(pytz.timezone("Europe/Rome")).strftime(STORING_FORMAT)
         chat_id = update.message.chat_id
 
-        count = get_count(username, today, chat_id) + 1
-        update_count(username, today, count, chat_id)
+        def increment():
+            count = get_count(username, today, chat_id) + 1
+            update_count(username, today, count, chat_id)
+            return count
+
+        # Wait for the commit in a worker thread, the updates of this chat are kept in order by the update processor
+        count = await asyncio.to_thread(increment)
 
         response = f"Complimenti @{username}, oggi hai fatto 💩 {count} " + ("volte!" if count > 1 else "volta!")
 
@@ -386,21 +593,181 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Log for debugging
     logging.info(f"Messaggio ricevuto da @{username}: {text} | Risposta: {response}")
 
+# Function to get the chats handled by this process
+def get_owned_chat_ids(context: ContextTypes.DEFAULT_TYPE):
+    """Get the IDs of the chats owned by this worker, all of them when running in a single process."""
+    index, workers = context.bot_data['worker']
+    return [chat_id for chat_id in get_chat_ids() if route_chat(chat_id, workers) == index]
+
+# Jobs
+async def precompute_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job precomputing rankings, statistics and charts of the periods just closed for every chat."""
+    now = datetime.now(pytz.timezone('Europe/Rome'))
+    last_month = now.replace(day=1) - timedelta(days=1)
+    periods = [('month', last_month.strftime('%m-%Y'))]
+    if now.month == 1:
+        periods.append(('year', last_month.strftime('%Y')))
+
+    for chat_id in get_owned_chat_ids(context):
+        for time_period, date in periods:
+            try:
+                # Render in a worker thread to keep serving updates in the meantime
+                await asyncio.to_thread(precompute_period, chat_id, time_period, date)
+            except Exception as e:
+                logger.error(f"Error precomputing {time_period} {date} for chat {chat_id}: {e}")
+
+    logger.info(f"Precomputed {', '.join(date for _, date in periods)} for all the chats")
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job archiving the closed years of every chat."""
+    for chat_id in get_owned_chat_ids(context):
+        try:
+            years = await asyncio.to_thread(archive_closed_years, chat_id)
+            if years:
+                logger.info(f"Archived years {', '.join(years)} for chat {chat_id}")
+        except Exception as e:
+            logger.error(f"Error archiving chat {chat_id}: {e}")
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job backing up the database of every chat, one at a time."""
+    for chat_id in get_owned_chat_ids(context):
+        try:
+            await asyncio.to_thread(backup_chat, chat_id)
+        except Exception as e:
+            logger.error(f"Error backing up chat {chat_id}: {e}")
+
+async def stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job logging the counters of the message filter and of the query cache."""
+    accepted, dropped = TRIGGERS.counters['accepted'], TRIGGERS.counters['dropped']
+    total = accepted + dropped
+    logger.info(f"Message filter: {dropped}/{total} messages dropped ({dropped / total if total else 0:.1%}), {accepted} handled")
+    cache_stats = get_query_cache_stats()
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    logger.info(f"Query cache: {cache_stats['hits']}/{lookups} hits ({cache_stats['hits'] / lookups if lookups else 0:.1%}), "
+                f"{cache_stats['entries']} entries, {cache_stats['bytes'] / 1024:.0f} KiB")
+
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job writing the counts changed in memory to disk."""
+    try:
+        await asyncio.to_thread(checkpoint_hot_tier)
+    except Exception as e:
+        logger.error(f"Error checkpointing the in-memory counts: {e}")
+
+# Checkpoint of the in-memory counts when the bot stops
+async def checkpoint_on_shutdown(application: Application):
+    """Write the counts changed in memory to disk before exiting."""
+    await asyncio.to_thread(checkpoint_hot_tier)
+    logger.info("In-memory counts written to disk")
+
+# Catch-up of the updates sent while the bot was down
+async def catch_up(application: Application):
+    """Count the 💩 sent while the bot was down, with one transaction and one summary message per chat."""
+    bot = application.bot
+    rome = pytz.timezone('Europe/Rome')
+    increments = defaultdict(lambda: defaultdict(int))  # chat_id -> (username, date) -> count
+    offset = None
+    skipped = 0
+
+    # getUpdates is refused while a webhook is set, its pending updates are kept
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    # Fetch the whole backlog, grouping the 💩 by chat, user and day of the message
+    while True:
+        updates = await bot.get_updates(offset=offset, timeout=0, allowed_updates=Update.MESSAGE)
+        if not updates:
+            break
+        for update in updates:
+            offset = update.update_id + 1
+            message = update.message
+            if not message or not message.text:
+                continue
+            text = message.text.lower().strip()
+            # Same precedence as handle_message: messages to the bot are not counted
+            if BOT_USERNAME not in text and "💩" in text:
+                date = message.date.astimezone(rome).strftime(STORING_FORMAT)
+                increments[message.chat_id][(message.from_user.username, date)] += 1
+            else:
+                skipped += 1
+
+    for chat_id, chat_increments in increments.items():
+        try:
+            add_counts(chat_id, chat_increments)
+        except Exception as e:
+            logger.error(f"Error in catch-up for chat {chat_id}: {e}")
+            continue
+
+        user_totals = defaultdict(int)
+        for (username, _), count in chat_increments.items():
+            user_totals[username] += count
+        lines = ["Ero offline, ho contato le 💩 mandate nel frattempo:"]
+        for username, count in sorted(user_totals.items(), key=lambda item: -item[1]):
+            lines.append(f"@{username}: {count}")
+        # The counts are already stored, a chat that cannot be reached must not stop the other ones
+        try:
+            for message in split_message(lines):
+                await bot.send_message(chat_id, message)
+        except TelegramError as e:
+            logger.error(f"Error sending the catch-up summary to chat {chat_id}: {e}")
+
+    logger.info(f"Catch-up: {sum(len(chat_increments) for chat_increments in increments.values())} counts updated in {len(increments)} chats, {skipped} messages skipped")
+
+# Function to catch up in the dispatcher, before the workers start
+async def catch_up_before_dispatch(token, base_url=None):
+    """Run the catch-up in this process, so that the backlog is counted on the day of each message before the workers own the chats."""
+    application = build_application(token, base_url, updater=False)
+    async with application:
+        await catch_up(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
 # Error handler
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for logging errors."""
     logger.error(f'Update "{update}" caused error "{context.error}"')
 
-# Main function to handle bot interactions
-"""Main function to start the bot."""
-if __name__ == '__main__':
-    # Create the Application instance
-    application = Application.builder().token(BOT_TOKEN).build()
+# Function to build the Application with all the handlers and jobs
+def build_application(token, base_url=None, updater=True, worker=(0, 1), concurrency=CONCURRENT_UPDATES):
+    """
+    Builds the Application of the bot.
+
+    Args:
+        token (str): Token of the bot.
+        base_url (str): Base URL of the Bot API, None for the official one.
+        updater (bool): Whether the Application fetches updates itself, False when they are fed by a dispatcher.
+        worker (tuple): Index of this worker and total number of workers, used to pick the chats it owns.
+        concurrency (int): Maximum number of updates processed at the same time, 1 for sequential processing.
+
+    Returns:
+        Application: The Application instance.
+    """
+    builder = Application.builder().token(token)
+    if base_url:
+        builder.base_url(base_url)
+    if concurrency > 1:
+        builder.concurrent_updates(ChatOrderedUpdateProcessor(concurrency))
+    if not updater:
+        builder.updater(None)
+    elif CATCH_UP:
+        # Runs before polling starts, which then drops whatever is left
+        builder.post_init(catch_up)
+    if TIERED_STORAGE:
+        enable_hot_tier()
+        builder.post_shutdown(checkpoint_on_shutdown)
+    application = builder.build()
+    application.bot_data['worker'] = worker
+    if worker[1] > 1:
+        # The chats of the other workers are written elsewhere, their query results are not cached here
+        set_owned_chats(lambda chat_id: route_chat(chat_id, worker[1]) == worker[0])
 
     # Add handlers
     application.add_handler(CommandHandler('start', start_command))
     application.add_handler(CommandHandler('classifica_mese', classifica_mese_command))
     application.add_handler(CommandHandler('classifica_anno', classifica_anno_command))
+    application.add_handler(CommandHandler('classifica_globale_mese', classifica_globale_mese_command))
+    application.add_handler(CommandHandler('classifica_globale_anno', classifica_globale_anno_command))
+    application.add_handler(CommandHandler('classifica_giorni', classifica_giorni_command))
+    application.add_handler(CommandHandler('classifica_periodo', classifica_periodo_command))
+    application.add_handler(CommandHandler('classifica_settimana', classifica_settimana_command))
     application.add_handler(CommandHandler('statistiche_mese', statistiche_mese_command))
     application.add_handler(CommandHandler('statistiche_anno', statistiche_anno_command))
     application.add_handler(CommandHandler('record', record_command))
@@ -409,15 +776,46 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('conto_giorno', conto_giorno_command))
     application.add_handler(CommandHandler('costipazione', costipazione_command))
 
-    # Messages
-    application.add_handler(MessageHandler(filters.TEXT, handle_message))
+    # Messages, irrelevant ones are dropped before creating a handler task
+    application.add_handler(MessageHandler(filters.TEXT & TRIGGERS, handle_message))
 
     # Errors
     application.add_error_handler(error)
 
-    # Polling
-    while True:
-        try:
-            application.run_polling(allowed_updates = Update.MESSAGE, drop_pending_updates = True)
-        except Exception as e:
-            logger.error(f"Error in polling: {e}")
\ No newline at end of file
+    # Jobs
+    hour, minute = PRECOMPUTE_TIME.split(':')
+    application.job_queue.run_monthly(precompute_job, when=time(int(hour), int(minute), tzinfo=pytz.timezone('Europe/Rome')), day=1)
+    hour, minute = ARCHIVE_TIME.split(':')
+    application.job_queue.run_monthly(archive_job, when=time(int(hour), int(minute), tzinfo=pytz.timezone('Europe/Rome')), day=1)
+    hour, minute = BACKUP_TIME.split(':')
+    application.job_queue.run_daily(backup_job, time=time(int(hour), int(minute), tzinfo=pytz.timezone('Europe/Rome')))
+    application.job_queue.run_repeating(stats_job, interval=STATS_INTERVAL, first=STATS_INTERVAL)
+    if TIERED_STORAGE:
+        application.job_queue.run_repeating(checkpoint_job, interval=CHECKPOINT_INTERVAL, first=CHECKPOINT_INTERVAL)
+
+    return application
+
+# Main function to handle bot interactions
+"""Main function to start the bot."""
+if __name__ == '__main__':
+    if BOT_WORKERS > 0:
+        # Dispatcher mode: this process fetches the updates and the workers handle them
+        # With CATCH_UP the backlog is counted first, the workers only get what arrives after it
+        if CATCH_UP:
+            asyncio.run(catch_up_before_dispatch(BOT_TOKEN, BOT_API_BASE_URL))
+        source = None
+        if WEBHOOK_URL:
+            source = webhook_updates(BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PORT, secret_token=WEBHOOK_SECRET,
+                                     base_url=BOT_API_BASE_URL, drop_pending_updates=not CATCH_UP)
+        run_dispatcher(BOT_TOKEN, BOT_WORKERS, BOT_API_BASE_URL, source=source, drop_pending_updates=not CATCH_UP)
+    else:
+        # Create the Application instance
+        application = build_application(BOT_TOKEN, BOT_API_BASE_URL)
+
+        # Polling
+        while True:
+            try:
+                # catch_up confirms the backlog it counted, what arrives during the catch-up is handled by polling
+                application.run_polling(allowed_updates = Update.MESSAGE, drop_pending_updates = not CATCH_UP)
+            except Exception as e:
+                logger.error(f"Error in polling: {e}")
@@ -1,6 +1,18 @@
 import os
+import sys
 import sqlite3
+import time
+import heapq
+import bisect
+import queue
+import inspect
+import functools
+import itertools
+import threading
+from array import array
 from datetime import datetime
+from collections import defaultdict, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 import calendar
 
@@ -8,7 +20,278 @@ import calendar
 STORING_FORMAT = "%Y-%m-%d"  # Format used for storing dates in the database
 DISPLAY_FORMAT = "%d-%m-%Y"  # Format used for displaying dates in messages
 DB_FOLDER = 'db'
+DB_SUFFIX = '_bot_data.db'
+ARCHIVE_FOLDER = os.path.join(DB_FOLDER, 'archive')  # Daily rows of the archived years
 CHARTS_FOLDER = 'charts'
+GLOBAL_RANK_WORKERS = 8  # Number of threads used to scan the chat databases
+GLOBAL_RANK_CACHE_SECONDS = 300  # How long a global rank is served from cache
+WRITE_BATCH_SIZE = 100  # Maximum number of mutations committed in a single transaction
+BUSY_TIMEOUT = 5  # Seconds a connection waits for a lock before failing
+WRITER_IDLE_SECONDS = 60  # Seconds without writes after which a chat writer closes its connection and thread
+QUERY_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Approximate memory cap of the query cache
+RANGE_INDEX_MAX_BYTES = 64 * 1024 * 1024  # Memory cap of the in-memory range indexes
+
+# Per-chat data versions, bumped on every write to invalidate derived results
+_data_versions = defaultdict(int)
+
+# Per-month data versions, bumped only for the months written: (chat_id, 'YYYY-MM') -> version
+_month_versions = defaultdict(int)
+
+# Cache for the global ranks: (time_period, date, top_k) -> (timestamp, rank)
+_global_rank_cache = {}
+_global_rank_cache_lock = threading.Lock()
+
+# Function telling whether this process writes a chat, None if it writes all of them
+_owns_chat = None
+
+# LRU cache of the query results: (chat_id, function, args, day) -> (data version, size, result)
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+_query_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+# LRU of the in-memory range indexes: chat_id -> RangeIndex
+_range_indexes = OrderedDict()
+_range_indexes_lock = threading.Lock()
+
+# Single writer of every chat database: chat_id -> ChatWriter
+_writers = {}
+_writers_lock = threading.Lock()
+
+# Chats whose database schema is up to date in this process
+_initialized = set()
+
+# Tables of a chat database, created by init_database
+_TABLES = ('user_count', 'user_count_runs', 'user_count_monthly', 'archived_years')
+
+# Hot tiers of the current month: chat_id -> HotTier, used only if enabled
+_hot_tier_enabled = False
+_hot_tiers = {}
+_hot_tiers_lock = threading.Lock()
+
+# Daily counts in the date range [:start, :end] of one user (or of everyone if :username is NULL),
+# merging the daily rows with the run-length encoded rows of the archived years
+_DAILY_COUNT_CTE = '''WITH RECURSIVE archived_count (username, date, end_date, count) AS (
+                          SELECT username, MAX(start_date, :start), MIN(end_date, :end), count
+                          FROM user_count_runs
+                          WHERE start_date <= :end AND end_date >= :start AND (:username IS NULL OR username = :username)
+                          UNION ALL
+                          SELECT username, date(date, '+1 day'), end_date, count
+                          FROM archived_count
+                          WHERE date < end_date),
+                      daily_count (username, date, count) AS (
+                          SELECT username, date, count
+                          FROM user_count
+                          WHERE date BETWEEN :start AND :end AND (:username IS NULL OR username = :username)
+                          UNION ALL
+                          SELECT username, date, count
+                          FROM archived_count)
+                      '''
+
+# Function to get the path of the database of a chat
+def get_db_path(chat_id):
+    """Get the path of the SQLite database of a chat."""
+    return os.path.join(DB_FOLDER, f'{chat_id}{DB_SUFFIX}')
+
+# Function to open a read connection to the database of a chat
+def _connect(chat_id):
+    """Open a read connection, which in WAL mode reads a snapshot and never blocks the writer."""
+    path = get_db_path(chat_id)
+    if chat_id not in _initialized and os.path.exists(path):
+        # A database already set up is read without starting its writer
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' * len(_TABLES))})", _TABLES)
+        if c.fetchone()[0] == len(_TABLES):
+            _initialized.add(chat_id)
+            return conn
+        conn.close()
+    if chat_id not in _initialized:
+        init_database(chat_id)
+    return sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+
+class ChatWriter:
+    """
+    Single writer of a chat database, which serializes and batches all its mutations in one thread.
+    After WRITER_IDLE_SECONDS without mutations it closes its connection and stops, the next write starts a new one.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f'writer-{chat_id}', daemon=True)
+        self._thread.start()
+
+    def submit(self, mutation, changes_data=True, transaction=True):
+        """
+        Queue a mutation, a function taking a cursor, and return a Future with its result. Called holding _writers_lock.
+        Mutations with transaction=False, like VACUUM, run alone in autocommit mode.
+        """
+        future = Future()
+        self._queue.put((mutation, changes_data, transaction, future))
+        return future
+
+    @staticmethod
+    def _commit(c, mutations):
+        """Run mutations in one transaction and return their (result, exception) pairs."""
+        results = []
+        c.execute('BEGIN IMMEDIATE')
+        for mutation in mutations:
+            # A failing mutation is rolled back without affecting the rest of the batch
+            c.execute('SAVEPOINT mutation')
+            try:
+                results.append((mutation(c), None))
+                c.execute('RELEASE mutation')
+            except Exception as e:
+                c.execute('ROLLBACK TO mutation')
+                c.execute('RELEASE mutation')
+                results.append((None, e))
+        c.execute('COMMIT')
+        return results
+
+    def _run(self):
+        conn = None
+        while True:
+            # Wait for a mutation, then take all the ones already queued
+            try:
+                batch = [self._queue.get(timeout=WRITER_IDLE_SECONDS)]
+            except queue.Empty:
+                # Mutations are submitted holding the lock, so none can be lost after this check
+                with _writers_lock:
+                    if self._queue.empty():
+                        del _writers[self.chat_id]
+                        break
+                continue
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            try:
+                if conn is None:
+                    # Autocommit mode, transactions are handled explicitly
+                    conn = sqlite3.connect(get_db_path(self.chat_id), timeout=BUSY_TIMEOUT, isolation_level=None)
+                    c = conn.cursor()
+                    c.execute('PRAGMA journal_mode=WAL')
+                # Consecutive mutations share a transaction, the ones outside of transactions run alone in order
+                for transaction, group in itertools.groupby(batch, key=lambda item: item[2]):
+                    mutations = [mutation for mutation, _, _, _ in group]
+                    if transaction:
+                        results.extend(self._commit(c, mutations))
+                        continue
+                    for mutation in mutations:
+                        try:
+                            results.append((mutation(c), None))
+                        except Exception as e:
+                            results.append((None, e))
+            except Exception as e:
+                # Start over with a new connection at the next batch, whatever state this one is in
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                # The groups already committed keep their results
+                results.extend([(None, e)] * (len(batch) - len(results)))
+
+            # Maintenance mutations leave the results unchanged, so they keep the derived data valid
+            if any(changes_data for _, changes_data, _, _ in batch):
+                _data_versions[self.chat_id] += 1
+            for (_, _, _, future), (result, exception) in zip(batch, results):
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+
+        if conn is not None:
+            conn.close()
+
+# Function to run a mutation on the database of a chat
+def _write(chat_id, mutation, changes_data=True, transaction=True):
+    """Run a mutation through the writer of the chat and wait until it is committed."""
+    with _writers_lock:
+        writer = _writers.get(chat_id)
+        if writer is None:
+            writer = _writers[chat_id] = ChatWriter(chat_id)
+        future = writer.submit(mutation, changes_data, transaction)
+    return future.result()
+
+# Function to estimate the memory used by a query result
+def _get_size(value):
+    """Estimate the memory used by a value made of lists, tuples, dicts and scalars."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_get_size(key) + _get_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_get_size(item) for item in value)
+    return size
+
+# Function to call a function through the query cache
+def cached_call(chat_id, name, args, function):
+    """
+    Return the cached result of function, identified by chat_id, name and args, computing it
+    if it is missing or the data of the chat changed since. Results are also keyed by the current
+    day, since the statistics of the current period depend on it.
+    """
+    if _owns_chat is not None and not _owns_chat(chat_id):
+        # Another process writes the chat, so the data version of this one says nothing about it
+        return function()
+
+    key = (chat_id, name, args, datetime.now().date())
+    # Read the version before the query, so that concurrent writes invalidate the result
+    version = get_data_version(chat_id)
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry is not None and entry[0] == version:
+            _query_cache.move_to_end(key)
+            _query_cache_stats['hits'] += 1
+            return entry[2]
+        _query_cache_stats['misses'] += 1
+
+    result = function()
+    size = _get_size(result)
+
+    with _query_cache_lock:
+        old_entry = _query_cache.pop(key, None)
+        if old_entry is not None:
+            _query_cache_stats['bytes'] -= old_entry[1]
+        _query_cache[key] = (version, size, result)
+        _query_cache_stats['bytes'] += size
+        # Evict the least recently used results
+        while _query_cache_stats['bytes'] > QUERY_CACHE_MAX_BYTES and len(_query_cache) > 1:
+            _, (_, evicted_size, _) = _query_cache.popitem(last=False)
+            _query_cache_stats['bytes'] -= evicted_size
+    return result
+
+# Function to set the chats written by this process
+def set_owned_chats(owns_chat):
+    """Set the function telling whether this process writes a chat, when the chats are split among processes."""
+    global _owns_chat
+    _owns_chat = owns_chat
+
+# Decorator caching a query function
+def cached_query(function):
+    """Decorator serving the results of a query function, which takes a chat_id, from the query cache."""
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        chat_id = arguments.pop('chat_id')
+        # Normalize the months, so that '3-2024' and '03-2024' share the same result
+        if arguments.get('time_period') == 'month' and '-' in arguments.get('date', ''):
+            month, year = arguments['date'].split('-', 1)
+            arguments['date'] = f'{month.zfill(2)}-{year}'
+        return cached_call(chat_id, function.__name__, tuple(arguments.items()), lambda: function(*args, **kwargs))
+
+    return wrapper
+
+# Function to get the counters of the query cache
+def get_query_cache_stats():
+    """Get the hits, misses, entries and approximate bytes of the query cache."""
+    with _query_cache_lock:
+        return dict(_query_cache_stats, entries=len(_query_cache))
 
 # Function to initialize the database
 def init_database(chat_id):
@@ -16,25 +299,34 @@ def init_database(chat_id):
     # Check if the database folder exists, if not, create it
     if not os.path.exists(DB_FOLDER):
         os.makedirs(DB_FOLDER)
-    # Connect to the database file, creating it if it doesn't exist
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
-    c = conn.cursor()
-    # Create the user_count table if it doesn't exist
-    c.execute('''CREATE TABLE IF NOT EXISTS user_count
-                 (username TEXT,
-                 date TEXT,
-                 count INTEGER DEFAULT 0,
-                 PRIMARY KEY (username, date))''')
-    conn.commit()
-    conn.close()
+    def mutation(c):
+        # Create the user_count table if it doesn't exist
+        c.execute('''CREATE TABLE IF NOT EXISTS user_count
+                     (username TEXT,
+                     date TEXT,
+                     count INTEGER DEFAULT 0,
+                     PRIMARY KEY (username, date))''')
+        # Create the tables of the archived years: runs of consecutive days with the same count and monthly totals
+        c.execute('''CREATE TABLE IF NOT EXISTS user_count_runs
+                     (username TEXT,
+                     start_date TEXT,
+                     end_date TEXT,
+                     count INTEGER,
+                     PRIMARY KEY (username, start_date))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS user_count_monthly
+                     (username TEXT,
+                     month TEXT,
+                     count INTEGER,
+                     PRIMARY KEY (username, month))''')
+        c.execute('CREATE TABLE IF NOT EXISTS archived_years (year TEXT PRIMARY KEY)')
+
+    # The writer creates the database file in WAL mode
+    _write(chat_id, mutation, changes_data=False)
+    _initialized.add(chat_id)
 
 # Function to get the count of poop emojis for a given user and date
 def get_count(username, date, chat_id):
     """Get the count of poop emojis for a given user and date."""
-    # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
-    c = conn.cursor()
-    
     # Determine if the input date is a day, a month, or invalid
     try:
         parsed_date = datetime.strptime(date, STORING_FORMAT)
@@ -54,11 +346,25 @@ def get_count(username, date, chat_id):
                 start_date = parsed_date.strftime(STORING_FORMAT)
                 end_date = parsed_date.strftime(STORING_FORMAT)
             except ValueError:
-                conn.close()
                 return 0
+
+    # The current month is served from memory
+    tier = _get_hot_tier_for(chat_id, start_date)
+    if tier is not None:
+        return tier.get_count(username, start_date if start_date == end_date else start_date[:7])
+
+    # Connect to the database
+    conn = _connect(chat_id)
+    c = conn.cursor()
     
-    # Execute SQL query to retrieve the count for the specified user and date or month
-    c.execute('SELECT SUM(count) FROM user_count WHERE username = ? AND date BETWEEN ? AND ?', (username, start_date, end_date))
+    # Execute SQL query to retrieve the count for the specified user and date or month, including the archived runs
+    c.execute('''SELECT COALESCE((SELECT SUM(count)
+                                  FROM user_count
+                                  WHERE username = :username AND date BETWEEN :start AND :end), 0)
+                      + COALESCE((SELECT SUM(count * (CAST(julianday(MIN(end_date, :end)) - julianday(MAX(start_date, :start)) AS INTEGER) + 1))
+                                  FROM user_count_runs
+                                  WHERE username = :username AND start_date <= :end AND end_date >= :start), 0)''',
+              {'username': username, 'start': start_date, 'end': end_date})
     row = c.fetchone()
     conn.close()
     
@@ -71,18 +377,78 @@ def get_count(username, date, chat_id):
 # Function to update the count of poop emojis for a given user and date
 def update_count(username, date, count, chat_id):
     """Update the count of poop emojis for a given user and date."""
-    # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
-    c = conn.cursor()
-    # Delete existing count for the specified user and date
-    c.execute('DELETE FROM user_count WHERE username = ? AND date = ?', (username, date))
-    # If the count is greater than 0, insert the new count
-    if count > 0:
-        c.execute('INSERT INTO user_count (username, date, count) VALUES (?, ?, ?)', (username, date, count))
-    conn.commit()
-    conn.close()
+    def mutation(c):
+        _unarchive_year(c, date[:4])
+        # Delete existing count for the specified user and date
+        c.execute('DELETE FROM user_count WHERE username = ? AND date = ?', (username, date))
+        # If the count is greater than 0, insert the new count
+        if count > 0:
+            c.execute('INSERT INTO user_count (username, date, count) VALUES (?, ?, ?)', (username, date, count))
+
+    tier = _get_hot_tier_for(chat_id, date, load=True)
+    if tier is not None:
+        tier.set_count(username, date, count)
+        _data_versions[chat_id] += 1
+    else:
+        _write(chat_id, mutation)
+    _bump_month_versions(chat_id, [date])
+    _patch_range_index(chat_id, [(username, date, count)])
+
+# Function to add counts of poop emojis for many users and dates at once
+def add_counts(chat_id, increments):
+    """
+    Add the counts of poop emojis, given as {(username, date): count}, in a single transaction.
+    Negative counts subtract, without going below 0. Return {(username, date): (old_count, new_count)}.
+    """
+    # The increments of the current month are applied in memory, the others on disk
+    tier = _get_hot_tier(chat_id, load=True)
+    hot_increments = {key: count for key, count in increments.items() if tier is not None and key[1][:7] == tier.month}
+    increments = {key: count for key, count in increments.items() if key not in hot_increments}
+
+    def mutation(c):
+        changes = {}
+        for (username, date), count in increments.items():
+            _unarchive_year(c, date[:4])
+            c.execute('SELECT count FROM user_count WHERE username = ? AND date = ?', (username, date))
+            row = c.fetchone()
+            old_count = row[0] if row else 0
+            new_count = max(0, old_count + count)
+            c.execute('DELETE FROM user_count WHERE username = ? AND date = ?', (username, date))
+            if new_count > 0:
+                c.execute('INSERT INTO user_count (username, date, count) VALUES (?, ?, ?)', (username, date, new_count))
+            changes[(username, date)] = (old_count, new_count)
+        return changes
+
+    changes = _write(chat_id, mutation) if increments else {}
+    if hot_increments:
+        for (username, date), count in hot_increments.items():
+            changes[(username, date)] = tier.add_count(username, date, count)
+        _data_versions[chat_id] += 1
+    _bump_month_versions(chat_id, [date for _, date in changes])
+    _patch_range_index(chat_id, [(username, date, new_count) for (username, date), (_, new_count) in changes.items()])
+    return changes
+
+# Function to get the data version of a chat
+def get_data_version(chat_id):
+    """Get the data version of a chat, which changes every time its counts are updated."""
+    return _data_versions[chat_id]
+
+# Function to get the data version of a period of a chat
+def get_period_version(chat_id, time_period, date):
+    """Get the data version of a month ('month-year') or a year of a chat, which changes only when the counts of the period are updated."""
+    if time_period == 'month':
+        month, year = date.split('-')
+        return _month_versions.get((chat_id, f'{year}-{int(month):02}'), 0)
+    return sum(_month_versions.get((chat_id, f'{date}-{month:02}'), 0) for month in range(1, 13))
+
+# Function to bump the data versions of the months written
+def _bump_month_versions(chat_id, dates):
+    """Bump the data versions of the months of the dates (STORING_FORMAT), after their counts are updated."""
+    for month in {date[:7] for date in dates}:
+        _month_versions[(chat_id, month)] += 1
 
 # Function to get the rank of users based on the count of poop emojis
+@cached_query
 def get_rank(chat_id, time_period, date):
     """Get the rank of users based on the count of poop emojis for the specified time period."""
     if time_period == 'month':
@@ -102,22 +468,41 @@ def get_rank(chat_id, time_period, date):
     else:
         raise ValueError("Invalid time_period. It should be 'month' or 'year'.")
 
+    # The current month, if in the period, is read from memory and left out of the query
+    tier = _get_hot_tier(chat_id)
+    if tier is not None and not start_period[:7] <= tier.month <= end_period[:7]:
+        tier = None
+    if tier is not None and time_period == 'month':
+        return sorted(tier.get_user_counts().items(), key=lambda item: -item[1])
+
     # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
+    conn = _connect(chat_id)
     c = conn.cursor()
 
-    # Execute SQL query to get the rank based on the time_period
+    # Execute SQL query to get the rank based on the time_period, using the monthly totals for the archived years
     c.execute('''SELECT username, SUM(count) AS partial_count
-              FROM user_count
-              WHERE date BETWEEN ? AND ?
+              FROM (SELECT username, count
+                    FROM user_count
+                    WHERE date BETWEEN :start AND :end AND (:hot_month IS NULL OR substr(date, 1, 7) != :hot_month)
+                    UNION ALL
+                    SELECT username, count
+                    FROM user_count_monthly
+                    WHERE month BETWEEN substr(:start, 1, 7) AND substr(:end, 1, 7))
               GROUP BY username
-              ORDER BY partial_count DESC''', (start_period, end_period))
+              ORDER BY partial_count DESC''', {'start': start_period, 'end': end_period, 'hot_month': tier.month if tier else None})
     
     rows = c.fetchall()
     conn.close()
+
+    if tier is not None:
+        totals = defaultdict(int, rows)
+        for username, count in tier.get_user_counts().items():
+            totals[username] += count
+        rows = sorted(totals.items(), key=lambda item: -item[1])
     return rows
 
 # Function to get statistics of users based on the count of poop emojis
+@cached_query
 def get_statistics(chat_id, time_period, date):
     """Get the statistics of users based on the count of poop emojis for the specified time period."""
     current_month = datetime.now().month
@@ -146,15 +531,17 @@ def get_statistics(chat_id, time_period, date):
     else:
         raise ValueError("Invalid time_period. It should be 'month' or 'year'.")
 
+    # The disk must hold the rows changed in memory
+    checkpoint_hot_tier(chat_id)
+
     # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
+    conn = _connect(chat_id)
     c = conn.cursor()
 
     # Execute SQL query to get the counts for each user in the specified period
-    c.execute('''SELECT username, count
-              FROM user_count
-              WHERE date BETWEEN ? AND ?
-              ORDER BY username''', (start_period, end_period))
+    c.execute(_DAILY_COUNT_CTE + '''SELECT username, count
+                                    FROM daily_count
+                                    ORDER BY username, date''', {'username': None, 'start': start_period, 'end': end_period})
 
     rows = c.fetchall()
     conn.close()
@@ -200,17 +587,20 @@ def get_statistics(chat_id, time_period, date):
     return sorted_user_statistics
 
 # Function to get the records for the specific user
+@cached_query
 def get_record(username, chat_id):
     """Get the records for the specific user."""
+    # The disk must hold the rows changed in memory
+    checkpoint_hot_tier(chat_id)
+
     # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
+    conn = _connect(chat_id)
     c = conn.cursor()
 
     # Execute SQL query to get the records for the specific user
-    c.execute('''SELECT date, count
-              FROM user_count
-              WHERE username = ?
-              ORDER BY date''', (username,))
+    c.execute(_DAILY_COUNT_CTE + '''SELECT date, count
+                                    FROM daily_count
+                                    ORDER BY date''', {'username': username, 'start': '0000-01-01', 'end': '9999-12-31'})
 
     rows = c.fetchall()
     conn.close()
@@ -220,24 +610,393 @@ def get_record(username, chat_id):
 # Function to get constipation days for the specific user
 def get_constipation_days(username, chat_id):
     """Get the constipation days for the specific user."""
+    # The disk must hold the rows changed in memory
+    checkpoint_hot_tier(chat_id)
+
     # Connect to the database
-    conn = sqlite3.connect(os.path.join(DB_FOLDER, f'{chat_id}_bot_data.db'))
+    conn = _connect(chat_id)
     c = conn.cursor()
 
     # Execute SQL query to get the constipation days for the specific user
-    c.execute('''SELECT date
-                 FROM user_count
-                 WHERE username = ? AND count > 0
-                 ORDER BY date DESC
-                 LIMIT 1''', (username,))
+    c.execute('''SELECT MAX(date)
+                 FROM (SELECT MAX(date) AS date
+                       FROM user_count
+                       WHERE username = :username AND count > 0
+                       UNION ALL
+                       SELECT MAX(end_date)
+                       FROM user_count_runs
+                       WHERE username = :username)''', {'username': username})
     
     last_day = c.fetchone()
     conn.close()
     
-    if last_day:
+    if last_day and last_day[0]:
         last_day = datetime.strptime(last_day[0], "%Y-%m-%d").date()
         today = datetime.today().date()
         
         return (today - last_day).days
     
-    return None
\ No newline at end of file
+    return None
+
+# Function to get the IDs of all the chats with a database
+def get_chat_ids():
+    """Get the IDs of all the chats that have a database."""
+    if not os.path.exists(DB_FOLDER):
+        return []
+    return [int(filename[:-len(DB_SUFFIX)]) for filename in os.listdir(DB_FOLDER) if filename.endswith(DB_SUFFIX)]
+
+# Function to get the rank of users across all the chats
+def get_global_rank(time_period, date, top_k=10, cache_seconds=GLOBAL_RANK_CACHE_SECONDS, workers=GLOBAL_RANK_WORKERS):
+    """Get the top_k users across all the chats for the specified time period."""
+    key = (time_period, date, top_k)
+    now = time.monotonic()
+    with _global_rank_cache_lock:
+        # Evict the expired ranks, the dates come from the users
+        for expired_key in [cached_key for cached_key, (timestamp, _) in _global_rank_cache.items() if now - timestamp >= cache_seconds]:
+            del _global_rank_cache[expired_key]
+        cached = _global_rank_cache.get(key)
+    if cached:
+        return cached[1]
+
+    # Scan the chat databases in parallel, each with its own connection
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partial_ranks = executor.map(lambda chat_id: get_rank(chat_id, time_period, date), get_chat_ids())
+
+        # Merge the partial ranks, summing the counts of users present in more chats
+        totals = defaultdict(int)
+        for partial_rank in partial_ranks:
+            for username, partial_count in partial_rank:
+                totals[username] += partial_count
+
+    rank = heapq.nlargest(top_k, totals.items(), key=lambda item: item[1])
+    with _global_rank_cache_lock:
+        _global_rank_cache[key] = (time.monotonic(), rank)
+    return rank
+
+# Function to archive the closed years of a chat
+def archive_closed_years(chat_id):
+    """
+    Archive the years before the current one: their daily rows are moved to the archive file of the chat
+    and replaced by runs of consecutive days with the same count and by monthly totals, which give the same
+    results to every query. The freed pages are then returned to the file system.
+
+    Returns the list of the archived years.
+    """
+    current_year = datetime.now().strftime('%Y')
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+
+    def mutation(c):
+        c.execute('SELECT DISTINCT substr(date, 1, 4) FROM user_count WHERE date < ? ORDER BY 1', (f'{current_year}-01-01',))
+        years = [row[0] for row in c.fetchall()]
+        if not years:
+            return years
+
+        # Copy the daily rows to the archive file before deleting them
+        c.execute('SELECT username, date, count FROM user_count WHERE date < ? ORDER BY username, date', (f'{current_year}-01-01',))
+        rows = c.fetchall()
+        archive = sqlite3.connect(os.path.join(ARCHIVE_FOLDER, f'{chat_id}_archive.db'), timeout=BUSY_TIMEOUT)
+        archive.execute('''CREATE TABLE IF NOT EXISTS user_count
+                          (username TEXT,
+                          date TEXT,
+                          count INTEGER DEFAULT 0,
+                          PRIMARY KEY (username, date))''')
+        archive.executemany('INSERT OR REPLACE INTO user_count (username, date, count) VALUES (?, ?, ?)', rows)
+        archive.commit()
+        archive.close()
+
+        # Rows of a user are sorted by date, so runs and months are built in a single pass
+        runs = []
+        monthly_counts = defaultdict(int)
+        for username, date, count in rows:
+            if count <= 0:
+                continue
+            monthly_counts[(username, date[:7])] += count
+            day = datetime.strptime(date, STORING_FORMAT).toordinal()
+            if runs:
+                run_username, run_start, run_end, run_count = runs[-1]
+                # Runs never cross the end of a year, so that years can be restored one at a time
+                if run_username == username and run_count == count and run_end == day - 1 and run_start[:4] == date[:4]:
+                    runs[-1][2] = day
+                    continue
+            runs.append([username, date, day, count])
+
+        c.executemany('''INSERT INTO user_count_runs (username, start_date, end_date, count) VALUES (?, ?, ?, ?)''',
+                      [(username, start_date, datetime.fromordinal(end_day).strftime(STORING_FORMAT), count)
+                       for username, start_date, end_day, count in runs])
+        c.executemany('''INSERT INTO user_count_monthly (username, month, count) VALUES (?, ?, ?)
+                         ON CONFLICT (username, month) DO UPDATE SET count = count + excluded.count''',
+                      [(username, month, count) for (username, month), count in monthly_counts.items()])
+        c.executemany('INSERT OR IGNORE INTO archived_years (year) VALUES (?)', [(year,) for year in years])
+        c.execute('DELETE FROM user_count WHERE date < ?', (f'{current_year}-01-01',))
+        return years
+
+    init_database(chat_id)
+    years = _write(chat_id, mutation, changes_data=False)
+    if years:
+        _vacuum(chat_id)
+    return years
+
+# Function to move an archived year back to the daily rows
+def _unarchive_year(c, year):
+    """Restore the daily rows of an archived year before it is modified, so that its counts are never split in two tables."""
+    c.execute('SELECT 1 FROM archived_years WHERE year = ?', (year,))
+    if not c.fetchone():
+        return
+    c.execute(_DAILY_COUNT_CTE + '''INSERT INTO user_count (username, date, count)
+                                    SELECT username, date, count
+                                    FROM archived_count''', {'username': None, 'start': f'{year}-01-01', 'end': f'{year}-12-31'})
+    c.execute('DELETE FROM user_count_runs WHERE start_date BETWEEN ? AND ?', (f'{year}-01-01', f'{year}-12-31'))
+    c.execute('DELETE FROM user_count_monthly WHERE month BETWEEN ? AND ?', (f'{year}-01', f'{year}-12'))
+    c.execute('DELETE FROM archived_years WHERE year = ?', (year,))
+
+# Function to shrink the database file of a chat
+def _vacuum(chat_id):
+    """Return the free pages of the database to the file system, switching it to incremental auto-vacuum the first time."""
+    def maintenance(c):
+        if c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Changing the auto-vacuum mode requires a full VACUUM, done only once
+            c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            c.execute('VACUUM')
+        c.execute('PRAGMA incremental_vacuum').fetchall()
+
+    # Through the writer, so that the other writes of the chat wait for it in the queue instead of failing on the lock
+    _write(chat_id, maintenance, changes_data=False, transaction=False)
+
+class RangeIndex:
+    """
+    In-memory index of a chat: per-user cumulative counts over the days with counts, so that the sum over any
+    date range is O(log n) per user. Only those days are stored, however far apart they are.
+    """
+
+    def __init__(self, rows, version):
+        """Build the index from (username, date, count) rows."""
+        self.version = version
+        days = {datetime.strptime(date, STORING_FORMAT).toordinal() for _, date, _ in rows}
+        self.days = array('q', sorted(days))
+        positions = {day: i for i, day in enumerate(self.days)}
+        length = len(self.days) + 1
+
+        # prefix[username][i] is the total count of the days before days[i]
+        daily_counts = defaultdict(lambda: array('q', bytes(8 * length)))
+        for username, date, count in rows:
+            daily_counts[username][positions[datetime.strptime(date, STORING_FORMAT).toordinal()] + 1] += count
+        self.prefix = {}
+        for username, counts in daily_counts.items():
+            for i in range(1, length):
+                counts[i] += counts[i - 1]
+            self.prefix[username] = counts
+
+    def get_size(self):
+        """Get the memory used by the days and the cumulative counts, in bytes."""
+        return self.days.itemsize * len(self.days) + sum(counts.itemsize * len(counts) for counts in self.prefix.values())
+
+    def set_count(self, username, date, count):
+        """Patch the index after the count of a user in a day is set."""
+        day = datetime.strptime(date, STORING_FORMAT).toordinal()
+        i = bisect.bisect_left(self.days, day)
+        if i == len(self.days) or self.days[i] != day:
+            if count == 0:
+                return
+            # Add the day with a count of 0 for everyone
+            self.days.insert(i, day)
+            for counts in self.prefix.values():
+                counts.insert(i + 1, counts[i])
+        length = len(self.days) + 1
+        counts = self.prefix.setdefault(username, array('q', bytes(8 * length)))
+
+        delta = count - (counts[i + 1] - counts[i])
+        if delta:
+            for j in range(i + 1, length):
+                counts[j] += delta
+
+    def get_range_counts(self, start_date, end_date):
+        """Get the total count of every user in the days from start_date to end_date, both included."""
+        start = bisect.bisect_left(self.days, datetime.strptime(start_date, STORING_FORMAT).toordinal())
+        end = bisect.bisect_right(self.days, datetime.strptime(end_date, STORING_FORMAT).toordinal())
+        if start >= end:
+            return {}
+        return {username: counts[end] - counts[start] for username, counts in self.prefix.items()}
+
+# Function to keep the range indexes within the memory cap
+def _evict_range_indexes():
+    """Evict the least recently used range indexes until the loaded ones fit RANGE_INDEX_MAX_BYTES, holding _range_indexes_lock."""
+    size = sum(index.get_size() for index in _range_indexes.values())
+    while size > RANGE_INDEX_MAX_BYTES:
+        _, index = _range_indexes.popitem(last=False)
+        size -= index.get_size()
+
+# Function to get the range index of a chat
+def _get_range_index(chat_id):
+    """Get the range index of a chat, loading it on first access and evicting the least recently used ones over the memory cap."""
+    version = get_data_version(chat_id)
+    with _range_indexes_lock:
+        index = _range_indexes.get(chat_id)
+        if index is not None and index.version == version:
+            _range_indexes.move_to_end(chat_id)
+            return index
+
+    # The disk must hold the rows changed in memory
+    checkpoint_hot_tier(chat_id)
+    conn = _connect(chat_id)
+    c = conn.cursor()
+    c.execute(_DAILY_COUNT_CTE + '''SELECT username, date, count
+                                    FROM daily_count''', {'username': None, 'start': '0000-01-01', 'end': '9999-12-31'})
+    rows = c.fetchall()
+    conn.close()
+    index = RangeIndex(rows, version)
+
+    # An index over the cap by itself is used for this query only
+    with _range_indexes_lock:
+        _range_indexes[chat_id] = index
+        _evict_range_indexes()
+    return index
+
+# Function to patch the range index of a chat after a write
+def _patch_range_index(chat_id, changes):
+    """Apply the new (username, date, count) values to the range index of the chat, if it is loaded."""
+    with _range_indexes_lock:
+        index = _range_indexes.get(chat_id)
+        if index is None:
+            return
+        for username, date, count in changes:
+            index.set_count(username, date, count)
+        index.version = get_data_version(chat_id)
+        # New days and users grow the index
+        _evict_range_indexes()
+
+# Function to get the rank of users in a date range
+def get_range_rank(chat_id, start_date, end_date):
+    """Get the rank of users based on the count of poop emojis from start_date to end_date (STORING_FORMAT), both included."""
+    index = _get_range_index(chat_id)
+    # Writes patch the index in place
+    with _range_indexes_lock:
+        range_counts = index.get_range_counts(start_date, end_date)
+    return sorted(((username, count) for username, count in range_counts.items() if count > 0), key=lambda item: -item[1])
+
+class HotTier:
+    """Daily rows of the current month of a chat, kept in memory and checkpointed to the on-disk user_count table."""
+
+    def __init__(self, month, rows):
+        """Build the tier of a month (format: YYYY-MM) from its (username, date, count) rows."""
+        self.month = month
+        self.counts = {(username, date): count for username, date, count in rows}
+        self.dirty = set()  # (username, date) changed since the last checkpoint
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()  # Keeps the checkpoints of the tier in order
+
+    def get_count(self, username, date):
+        """Get the count of a user in a day, or in the whole month if date is YYYY-MM."""
+        with self.lock:
+            if len(date) == 7:
+                return sum(count for (name, _), count in self.counts.items() if name == username)
+            return self.counts.get((username, date), 0)
+
+    def get_user_counts(self):
+        """Get the total count of every user in the month."""
+        totals = defaultdict(int)
+        with self.lock:
+            for (username, _), count in self.counts.items():
+                totals[username] += count
+        return totals
+
+    def add_count(self, username, date, count):
+        """Add count to a user in a day, without going below 0, and return (old_count, new_count)."""
+        with self.lock:
+            old_count = self.counts.get((username, date), 0)
+            new_count = max(0, old_count + count)
+            self._set(username, date, new_count)
+        return old_count, new_count
+
+    def set_count(self, username, date, count):
+        """Set the count of a user in a day."""
+        with self.lock:
+            self._set(username, date, count)
+
+    def _set(self, username, date, count):
+        if count > 0:
+            self.counts[(username, date)] = count
+        else:
+            self.counts.pop((username, date), None)
+        self.dirty.add((username, date))
+
+    def take_dirty(self):
+        """Get the changed rows as {(username, date): count} and mark them clean."""
+        with self.lock:
+            rows = {key: self.counts.get(key, 0) for key in self.dirty}
+            self.dirty.clear()
+        return rows
+
+    def restore_dirty(self, rows):
+        """Mark rows as changed again after a failed checkpoint."""
+        with self.lock:
+            self.dirty.update(rows)
+
+# Function to enable the hot tier
+def enable_hot_tier(enabled=True):
+    """Serve the current month of the active chats from memory, see HotTier."""
+    global _hot_tier_enabled
+    _hot_tier_enabled = enabled
+
+# Function to get the hot tier of a chat
+def _get_hot_tier(chat_id, load=False):
+    """
+    Get the hot tier of a chat for the current month, None if the hot tier is disabled.
+    Only writes load it, so that the chats written by another process are always read from disk.
+    """
+    if not _hot_tier_enabled:
+        return None
+    month = datetime.now().strftime('%Y-%m')
+    with _hot_tiers_lock:
+        tier = _hot_tiers.get(chat_id)
+        if tier is not None and tier.month == month:
+            return tier
+        if tier is not None:
+            # The month is over: its rows go to disk and are read from there from now on
+            _checkpoint_tier(chat_id, tier)
+            del _hot_tiers[chat_id]
+        if not load:
+            return None
+
+        conn = _connect(chat_id)
+        c = conn.cursor()
+        c.execute('SELECT username, date, count FROM user_count WHERE date BETWEEN ? AND ?', (f'{month}-01', f'{month}-31'))
+        tier = _hot_tiers[chat_id] = HotTier(month, c.fetchall())
+        conn.close()
+    return tier
+
+# Function to write the changed rows of a hot tier to disk
+def _checkpoint_tier(chat_id, tier):
+    """Write the rows of the tier changed since the last checkpoint to the on-disk user_count table."""
+    with tier.checkpoint_lock:
+        rows = tier.take_dirty()
+        if not rows:
+            return
+
+        def mutation(c):
+            for (username, date), count in rows.items():
+                c.execute('DELETE FROM user_count WHERE username = ? AND date = ?', (username, date))
+                if count > 0:
+                    c.execute('INSERT INTO user_count (username, date, count) VALUES (?, ?, ?)', (username, date, count))
+
+        try:
+            # The counts served are already the new ones
+            _write(chat_id, mutation, changes_data=False)
+        except Exception:
+            tier.restore_dirty(rows)
+            raise
+
+# Function to checkpoint the hot tiers
+def checkpoint_hot_tier(chat_id=None):
+    """Write the rows changed in memory to disk, for one chat or for all the loaded ones."""
+    with _hot_tiers_lock:
+        tiers = [(loaded_chat_id, tier) for loaded_chat_id, tier in _hot_tiers.items() if chat_id is None or loaded_chat_id == chat_id]
+    for loaded_chat_id, tier in tiers:
+        _checkpoint_tier(loaded_chat_id, tier)
+
+# Function to get the hot tier of a chat for a date
+def _get_hot_tier_for(chat_id, date, load=False):
+    """Get the hot tier of a chat if it holds the date (STORING_FORMAT or YYYY-MM), None otherwise."""
+    tier = _get_hot_tier(chat_id, load)
+    if tier is not None and date[:7] == tier.month:
+        return tier
+    return None
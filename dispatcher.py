@@ -0,0 +1,260 @@
+import json
+import asyncio
+import logging
+import random
+import time
+import zlib
+import argparse
+import multiprocessing
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+POLLING_TIMEOUT = 30  # Seconds of long polling for getUpdates
+WEBHOOK_PORT = 8443  # Default local port of the webhook
+WEBHOOK_MAX_BODY = 1024 * 1024  # Largest update accepted by the webhook, in bytes
+WORKER_RESTART_SECONDS = 5  # Minimum seconds between two starts of the same worker, to avoid restart loops
+
+# Function to get the worker owning a chat
+def route_chat(chat_id, workers):
+    """Get the index of the worker owning a chat, stable across restarts."""
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+# Function to get the chat of a serialized update
+def get_update_chat_id(data):
+    """Get the chat ID of an update in dict form, None if it has no chat."""
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get('chat'), dict):
+            return value['chat'].get('id')
+    return None
+
+# Update sources
+async def poll_updates(token, base_url=None, drop_pending_updates=True):
+    """
+    Fetches the updates from the Bot API with long polling.
+
+    Args:
+        token (str): Token of the bot.
+        base_url (str): Base URL of the Bot API, None for the official one.
+        drop_pending_updates (bool): Whether the updates sent while the bot was down are dropped, instead of handled by the workers.
+
+    Yields:
+        dict: The updates in dict form.
+    """
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    async with bot:
+        await bot.delete_webhook(drop_pending_updates=drop_pending_updates)
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=Update.MESSAGE)
+            except TelegramError as e:
+                logger.error(f"Error in polling: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                yield update.to_dict()
+
+async def webhook_updates(token, url, port=WEBHOOK_PORT, listen='0.0.0.0', secret_token=None, base_url=None, drop_pending_updates=True):
+    """
+    Receives the updates from the Bot API with a webhook. Telegram only calls HTTPS URLs, so url is
+    usually a reverse proxy terminating TLS and forwarding the requests to listen:port.
+
+    Args:
+        token (str): Token of the bot.
+        url (str): Public URL of the webhook.
+        port (int): Local port the updates are received on.
+        listen (str): Local address the updates are received on.
+        secret_token (str): Secret sent by Telegram with every update, requests without it are refused.
+        base_url (str): Base URL of the Bot API, None for the official one.
+        drop_pending_updates (bool): Whether the updates sent while the bot was down are dropped, instead of handled by the workers.
+
+    Yields:
+        dict: The updates in dict form.
+    """
+    received = asyncio.Queue()
+
+    async def handle_connection(reader, writer):
+        # HTTP/1.1 with keep-alive: serve requests until Telegram closes the connection
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > WEBHOOK_MAX_BODY:
+                    writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    break
+                body = await reader.readexactly(length)
+
+                if not request_line.startswith('POST ') or (secret_token and headers.get('x-telegram-bot-api-secret-token') != secret_token):
+                    status = b'403 Forbidden'
+                else:
+                    try:
+                        await received.put(json.loads(body))
+                        status = b'200 OK'
+                    except ValueError:
+                        status = b'400 Bad Request'
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\n\r\n')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    async with bot:
+        server = await asyncio.start_server(handle_connection, listen, port)
+        async with server:
+            # The server is ready before Telegram starts sending
+            await bot.set_webhook(url, allowed_updates=Update.MESSAGE, drop_pending_updates=drop_pending_updates, secret_token=secret_token)
+            while True:
+                yield await received.get()
+
+async def fake_updates(chats=10, users=5, rate=50.0, total=None):
+    """
+    Generates fake updates for testing the dispatcher locally, without Telegram.
+    Every chat first sends /start, then random users send 💩.
+
+    Args:
+        chats (int): Number of chats.
+        users (int): Number of users in each chat.
+        rate (float): Updates per second.
+        total (int): Number of 💩 messages to generate, None to never stop.
+
+    Yields:
+        dict: The updates in dict form.
+    """
+    update_id = 0
+
+    def make_update(chat_id, user_id, text):
+        nonlocal update_id
+        update_id += 1
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else []
+            }
+        }
+
+    for chat in range(1, chats + 1):
+        yield make_update(-chat, 1, '/start')
+
+    sent = 0
+    while total is None or sent < total:
+        chat = random.randint(1, chats)
+        user = random.randint(1, users)
+        yield make_update(-chat, chat * 1000 + user, '💩')
+        sent += 1
+        await asyncio.sleep(1 / rate)
+
+# Worker process
+def run_worker(index, workers, updates, token, base_url=None):
+    """
+    Runs a worker process, handling the updates of the chats it owns.
+
+    Args:
+        index (int): Index of this worker.
+        workers (int): Total number of workers.
+        updates (multiprocessing.Queue): Queue of the updates in dict form, None to stop.
+        token (str): Token of the bot.
+        base_url (str): Base URL of the Bot API, None for the official one.
+    """
+    # Imported here, so that only the workers build an Application
+    from caccometro import build_application
+
+    application = build_application(token, base_url, updater=False, worker=(index, workers))
+    asyncio.run(_serve_worker(application, updates))
+
+async def _serve_worker(application, updates):
+    async with application:
+        await application.start()
+        logger.info(f"Worker {application.bot_data['worker'][0]} started")
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        # Same as run_polling, e.g. to write the in-memory counts to disk
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Dispatcher
+def run_dispatcher(token, workers, base_url=None, source=None, drop_pending_updates=True):
+    """
+    Runs the dispatcher, forwarding every update to the worker owning its chat.
+
+    Args:
+        token (str): Token of the bot.
+        workers (int): Number of worker processes.
+        base_url (str): Base URL of the Bot API, None for the official one.
+        source (async iterator): Source of the updates in dict form, polling the Bot API if None.
+        drop_pending_updates (bool): Whether the updates sent while the bot was down are dropped when polling.
+    """
+    # Spawn fresh interpreters, so that the workers do not inherit threads or event loops
+    context = multiprocessing.get_context('spawn')
+    queues = [None] * workers
+
+    def start_worker(index):
+        if queues[index] is not None:
+            # The queue of a dead worker may be left locked: the updates still in it are lost
+            queues[index].cancel_join_thread()
+            queues[index].close()
+        queues[index] = context.Queue()
+        process = context.Process(target=run_worker, args=(index, workers, queues[index], token, base_url), name=f'worker-{index}')
+        process.start()
+        return process
+
+    processes = [start_worker(index) for index in range(workers)]
+
+    try:
+        asyncio.run(_dispatch(source or poll_updates(token, base_url, drop_pending_updates), queues, processes, start_worker))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+
+async def _dispatch(source, queues, processes, start_worker):
+    forwarded = [0] * len(queues)
+    started = [time.monotonic()] * len(queues)
+    async for data in source:
+        chat_id = get_update_chat_id(data)
+        index = route_chat(chat_id, len(queues)) if chat_id is not None else 0
+        # A dead worker is restarted, its chats are silent until then
+        if not processes[index].is_alive() and time.monotonic() - started[index] >= WORKER_RESTART_SECONDS:
+            logger.error(f"Worker {index} died with exit code {processes[index].exitcode}, restarting it")
+            processes[index] = start_worker(index)
+            started[index] = time.monotonic()
+        queues[index].put(data)
+        forwarded[index] += 1
+    logger.info(f"Updates forwarded to each worker: {forwarded}")
+
+if __name__ == '__main__':
+    # Local test with fake updates: replies go to BOT_API_BASE_URL, e.g. a local Bot API server
+    from caccometro import BOT_TOKEN, BOT_API_BASE_URL
+
+    parser = argparse.ArgumentParser(description="Run the dispatcher with fake updates.")
+    parser.add_argument('--workers', type=int, default=4, help="Number of worker processes.")
+    parser.add_argument('--chats', type=int, default=10, help="Number of fake chats.")
+    parser.add_argument('--users', type=int, default=5, help="Number of fake users in each chat.")
+    parser.add_argument('--rate', type=float, default=50.0, help="Fake updates per second.")
+    parser.add_argument('--total', type=int, default=1000, help="Number of fake 💩 messages.")
+    args = parser.parse_args()
+
+    run_dispatcher(BOT_TOKEN or 'fake', args.workers, BOT_API_BASE_URL,
+                   source=fake_updates(args.chats, args.users, args.rate, args.total))
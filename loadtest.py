@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime
+from collections import Counter, defaultdict
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from email.policy import default as default_policy
+import pytz
+
+TOKEN = '123456:LOADTEST'
+BOT_USERNAME = 'caccometro_bot'
+COMMANDS = ['/conto_giorno', '/costipazione', '/classifica_mese', '/statistiche_mese', '/record']
+
+class FakeBotAPI:
+    """Local stand-in of the Telegram Bot API, answering getUpdates, sendMessage and sendPhoto from memory."""
+
+    def __init__(self):
+        self.port = None
+        self.pending = []  # Updates not yet confirmed by the bot
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_updates = None
+        self.polling = None
+        self.requests = Counter()  # Calls for each method
+        self.sent = {}  # (chat_id, message_id) -> time the update was queued
+        self.replies = {}  # (chat_id, message_id) -> time of the first reply
+        self.unmatched_replies = 0
+        self.lock = threading.Lock()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start serving on host and port, a free one if 0."""
+        self.new_updates = asyncio.Event()
+        self.polling = asyncio.Event()
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    def add_message(self, chat_id, user_id, text):
+        """Queue a group message as a new update and return its message_id."""
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.pending.append({
+                'update_id': self.next_update_id,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+                    'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else []
+                }
+            })
+            self.next_update_id += 1
+            self.sent[(chat_id, message_id)] = time.perf_counter()
+        self.new_updates.set()
+        return message_id
+
+    async def _handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive: serve requests until the client closes the connection
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                method = request_line.split(' ')[1].rstrip('/').split('/')[-1]
+                params = self._parse_params(headers.get('content-type', ''), body)
+                self.requests[method] += 1
+                try:
+                    response = {'ok': True, 'result': await self._call(method, params)}
+                except (KeyError, ValueError) as e:
+                    response = {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+
+                payload = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=default_policy).parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                # Uploaded files are only acknowledged
+                params[name] = '<file>' if part.get_filename() else part.get_content()
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    async def _call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Caccometro', 'username': BOT_USERNAME,
+                    'can_join_groups': True, 'can_read_all_group_messages': True, 'supports_inline_queries': False}
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method in ('sendMessage', 'sendPhoto'):
+            return self._send(method, params)
+        return True
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        with self.lock:
+            if offset:
+                # Updates before the offset are confirmed
+                self.pending = [update for update in self.pending if update['update_id'] >= offset]
+            if not self.pending:
+                self.new_updates.clear()
+        if not self.pending and timeout > 0:
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        with self.lock:
+            return self.pending[:limit]
+
+    def _send(self, method, params):
+        chat_id = int(params['chat_id'])
+        reply_to = params.get('reply_to_message_id')
+        if reply_to is None and params.get('reply_parameters'):
+            reply_parameters = params['reply_parameters']
+            reply_to = (json.loads(reply_parameters) if isinstance(reply_parameters, str) else reply_parameters)['message_id']
+
+        now = time.perf_counter()
+        with self.lock:
+            key = (chat_id, int(reply_to)) if reply_to is not None else None
+            if key in self.sent:
+                self.replies.setdefault(key, now)
+            else:
+                self.unmatched_replies += 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Caccometro', 'username': BOT_USERNAME}
+        }
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo{message_id}', 'file_unique_id': f'unique{message_id}', 'width': 1500, 'height': 1000}]
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+async def generate_load(api, args, expected_counts):
+    """Send 💩 and commands from random chats and users at the configured rate."""
+    rome = pytz.timezone('Europe/Rome')
+    await api.polling.wait()
+    interval = 1 / args.rate
+    next_time = time.perf_counter()
+    end_time = next_time + args.duration
+    while time.perf_counter() < end_time:
+        chat_id = -random.randint(1, args.chats)
+        user_id = -chat_id * 1000 + random.randint(1, args.users)
+        if random.random() < args.command_ratio:
+            api.add_message(chat_id, user_id, random.choice(COMMANDS))
+        else:
+            api.add_message(chat_id, user_id, '💩')
+            expected_counts[(chat_id, f'user{user_id}', datetime.now(rome).strftime('%Y-%m-%d'))] += 1
+        next_time += interval
+        await asyncio.sleep(max(0, next_time - time.perf_counter()))
+
+async def run_fake_api(api, args, expected_counts, ready, done):
+    """Serve the fake Bot API, generate the load and wait for the replies."""
+    await api.start()
+    ready.set()
+    await generate_load(api, args, expected_counts)
+    # Wait for the replies to the whole load, up to the drain timeout
+    deadline = time.perf_counter() + args.drain_timeout
+    while len(api.replies) < len(api.sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    done.set()
+    # Keep answering the bot until it stops polling
+    while True:
+        await asyncio.sleep(3600)
+
+async def run_bot(application, done):
+    """Run the Application with polling until the load is done."""
+    from telegram import Update
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(allowed_updates=Update.MESSAGE, poll_interval=0, timeout=1)
+        await asyncio.to_thread(done.wait)
+        await application.updater.stop()
+        await application.stop()
+
+def report(api, expected_counts):
+    """Print throughput, latency percentiles, error rate and lost increments."""
+    from database import get_count
+
+    latencies = sorted((api.replies[key] - api.sent[key]) * 1000 for key in api.replies)
+    answered = len(latencies)
+    total = len(api.sent)
+    # From the first update sent to the last reply received
+    elapsed = max(api.replies.values(), default=0) - min(api.sent.values(), default=0) or 1
+    print(f"Updates sent: {total}, answered: {answered}, elapsed: {elapsed:.1f} s")
+    print(f"Throughput: {answered / elapsed:.1f} updates/s")
+    if answered >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"Reply latency: p50 {percentiles[49]:.1f} ms, p95 {percentiles[94]:.1f} ms, p99 {percentiles[98]:.1f} ms, max {latencies[-1]:.1f} ms")
+    print(f"Error rate: {(total - answered) / total if total else 0:.2%} unanswered, {api.unmatched_replies} unmatched replies")
+    print(f"Bot API calls: {dict(api.requests)}")
+
+    # Every 💩 must be counted exactly once
+    lost = {key: expected - get_count(key[1], key[2], key[0]) for key, expected in expected_counts.items()}
+    lost = {key: difference for key, difference in lost.items() if difference}
+    print(f"Lost increments: {sum(lost.values())} over {len(lost)} (chat, user, day)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake Bot API.")
+    parser.add_argument('--chats', type=int, default=20, help="Number of chats.")
+    parser.add_argument('--users', type=int, default=5, help="Number of users in each chat.")
+    parser.add_argument('--rate', type=float, default=50.0, help="Updates per second.")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds of load.")
+    parser.add_argument('--command-ratio', type=float, default=0.1, help="Fraction of the updates that are commands.")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="Seconds to wait for the last replies.")
+    parser.add_argument('--concurrency', type=int, default=None, help="Updates processed at the same time, CONCURRENT_UPDATES if not set.")
+    parser.add_argument('--workdir', default=None, help="Directory of the test databases and charts, a temporary one if not set.")
+    args = parser.parse_args()
+
+    # Keep the test databases, charts and logs away from the real ones
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix='caccometro_loadtest_'))
+    os.environ['BOT_USERNAME'] = f'@{BOT_USERNAME}'
+    print(f"Working directory: {os.getcwd()}")
+
+    api = FakeBotAPI()
+    expected_counts = defaultdict(int)
+    ready = threading.Event()
+    done = threading.Event()
+    # The fake API runs in its own thread, so that blocking handlers do not delay it
+    threading.Thread(target=asyncio.run, args=(run_fake_api(api, args, expected_counts, ready, done),), daemon=True).start()
+    ready.wait()
+
+    from caccometro import build_application, CONCURRENT_UPDATES
+
+    application = build_application(TOKEN, base_url=f'http://127.0.0.1:{api.port}/bot',
+                                    concurrency=args.concurrency or CONCURRENT_UPDATES)
+    asyncio.run(run_bot(application, done))
+    report(api, expected_counts)
@@ -0,0 +1,85 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CHAT_ID = -1001  # Not used by the other tests, whose writers may still be open on their folder
+USERNAME = 'mario'
+LONG_RANGE = '01-01-2024:31-12-2024'  # 366 days, the longest accepted
+
+class FakeMessage:
+    """The parts of a Message used by /aggiungi and /togli, recording the replies."""
+
+    def __init__(self):
+        self.chat_id = CHAT_ID
+        self.from_user = SimpleNamespace(username=USERNAME)
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+class BackfillCommandsTest(unittest.TestCase):
+    """/aggiungi and /togli over long ranges of dates."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Keep the test databases and logs away from the real ones
+        cls.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix='caccometro_test_'))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+
+    def run_command(self, command, *args):
+        message = FakeMessage()
+        asyncio.run(command(SimpleNamespace(message=message), SimpleNamespace(args=list(args))))
+        return message.replies
+
+    def assertRepliesFit(self, replies):
+        from utils import MAX_MESSAGE_LENGTH
+        self.assertTrue(replies)
+        for reply in replies:
+            self.assertLessEqual(len(reply.encode('utf-16-le')) // 2, MAX_MESSAGE_LENGTH)
+
+    def test_long_range(self):
+        from caccometro import aggiungi_command, togli_command
+        from database import init_database, get_count
+
+        init_database(CHAT_ID)
+
+        # Every day is added once and listed once, over messages within the limit of Telegram
+        replies = self.run_command(aggiungi_command, f'@{USERNAME}', LONG_RANGE)
+        self.assertGreater(len(replies), 1)
+        self.assertRepliesFit(replies)
+        text = '\n'.join(replies)
+        self.assertEqual(text.count(' 💩'), 366)
+        self.assertIn('29-02-2024: 1 💩', text)
+        self.assertEqual(get_count(USERNAME, '2024-02-29', CHAT_ID), 1)
+
+        # Removing twice lists the days already at 0 too
+        self.run_command(togli_command, f'@{USERNAME}', LONG_RANGE)
+        replies = self.run_command(togli_command, f'@{USERNAME}', LONG_RANGE)
+        self.assertRepliesFit(replies)
+        self.assertIn('Non aggiornati poiché erano già a 0 💩:', replies[0])
+        self.assertEqual('\n'.join(replies).count('-2024'), 366)
+        self.assertEqual(get_count(USERNAME, '2024-02-29', CHAT_ID), 0)
+
+    def test_too_many_days(self):
+        from caccometro import aggiungi_command
+        from database import init_database, get_count
+
+        init_database(CHAT_ID)
+
+        # The limit holds for all the ranges together, and nothing is written when it is exceeded
+        replies = self.run_command(aggiungi_command, f'@{USERNAME}', LONG_RANGE, '01-01-2023:31-01-2023')
+        self.assertEqual(len(replies), 1)
+        self.assertTrue(replies[0].startswith('Errore: '))
+        self.assertEqual(get_count(USERNAME, '2023-01-01', CHAT_ID), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CHATS = 10
+USERS = 3
+MESSAGES = 300
+CONCURRENCY = 8
+DAY = '2024-05-01'
+
+class ChatOrderedUpdateProcessorTest(unittest.TestCase):
+    """Concurrent processing of the updates of many chats, as done by the Application with CONCURRENT_UPDATES > 1."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Keep the test databases and logs away from the real ones
+        cls.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix='caccometro_test_'))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+
+    def test_updates_in_order_and_no_lost_increments(self):
+        from telegram import Chat, Message, Update, User
+        from caccometro import ChatOrderedUpdateProcessor
+        from database import init_database, get_count, update_count
+
+        for chat in range(1, CHATS + 1):
+            init_database(-chat)
+
+        random.seed(0)
+        updates = []
+        expected_counts = defaultdict(int)
+        for message_id in range(1, MESSAGES + 1):
+            chat_id = -random.randint(1, CHATS)
+            user_id = random.randint(1, USERS)
+            updates.append(Update(message_id, message=Message(
+                message_id, datetime.now(), Chat(chat_id, Chat.GROUP),
+                from_user=User(user_id, f'User {user_id}', False, username=f'user{user_id}'), text='💩')))
+            expected_counts[(chat_id, f'user{user_id}')] += 1
+
+        processed = defaultdict(list)  # chat_id -> message_ids in the order they started
+        running = {'now': 0, 'max': 0}
+
+        async def handle(update):
+            chat_id = update.effective_chat.id
+            processed[chat_id].append(update.message.message_id)
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+
+            def increment():
+                # Same read-modify-write as handle_message, with a pause that would expose concurrent updates of a chat
+                count = get_count(update.message.from_user.username, DAY, chat_id) + 1
+                time.sleep(random.random() / 1000)
+                update_count(update.message.from_user.username, DAY, count, chat_id)
+
+            await asyncio.to_thread(increment)
+            running['now'] -= 1
+
+        async def dispatch():
+            processor = ChatOrderedUpdateProcessor(CONCURRENCY)
+            await processor.initialize()
+            # Like the Application, one task for each update in arrival order
+            await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+            await processor.shutdown()
+            return processor
+
+        processor = asyncio.run(dispatch())
+
+        # The updates of each chat started in arrival order
+        sent = defaultdict(list)
+        for update in updates:
+            sent[update.effective_chat.id].append(update.message.message_id)
+        self.assertEqual(dict(processed), dict(sent))
+
+        # Every increment was counted exactly once
+        for (chat_id, username), count in expected_counts.items():
+            self.assertEqual(get_count(username, DAY, chat_id), count, f"chat {chat_id}, {username}")
+
+        # Different chats ran concurrently, within the limit, and no chat lock is left behind
+        self.assertGreater(running['max'], 1)
+        self.assertLessEqual(running['max'], CONCURRENCY)
+        self.assertEqual(processor._chat_locks, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 import os
 import calendar
-import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
-from database import get_count, DISPLAY_FORMAT, CHARTS_FOLDER
+from matplotlib.figure import Figure
+from dotenv import load_dotenv
+from database import get_count, get_rank, get_statistics, get_period_version, STORING_FORMAT, DISPLAY_FORMAT, CHARTS_FOLDER
 import locale
+import pytz
 from math import ceil
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -15,6 +17,19 @@ locale.setlocale(locale.LC_TIME, 'it_IT.UTF-8')
 # Check if charts folder exists, if not, create it
 os.makedirs(CHARTS_FOLDER, exist_ok=True)
 
+MAX_BACKFILL_DAYS = 366  # Maximum number of days updated by a single command
+MAX_MESSAGE_LENGTH = 4096  # Maximum length of a Telegram message, in UTF-16 code units
+
+# Load chart encoding settings from .env
+load_dotenv()
+CHART_FORMAT = os.environ.get('CHART_FORMAT', 'png')  # 'png' or 'webp'
+CHART_DPI = int(os.environ.get('CHART_DPI', 100))  # Starting resolution of the charts
+CHART_MIN_DPI = 50  # Lowest resolution used to fit the size budget
+CHART_MAX_BYTES = int(os.environ.get('CHART_MAX_BYTES', 500 * 1024))  # Size budget of a chart image
+
+# Precomputed artifacts: (chat_id, time_period, date) -> dict with period version, rank, statistics and chart
+_precomputed = {}
+
 def ensure_datetime(value):
     if isinstance(value, str):
         try:
@@ -26,6 +41,86 @@ def ensure_datetime(value):
                 return None
     return value
 
+def parse_dates(specs):
+    """
+    Parses dates and ranges of dates, checking that none of them is in the future.
+
+    Args:
+        specs (list of str): Dates in 'DD-MM-YYYY' format or ranges in 'DD-MM-YYYY:DD-MM-YYYY' format.
+
+    Returns:
+        list of str: The dates in STORING_FORMAT, with the ranges expanded, in the given order.
+
+    Raises:
+        ValueError: If a date is not valid, a range is reversed or too long, or some dates are in the future.
+    """
+    dates = []
+    for spec in specs:
+        if ':' in spec:
+            start, end = spec.split(':', 1)
+            start_date = datetime.strptime(start, DISPLAY_FORMAT)
+            end_date = datetime.strptime(end, DISPLAY_FORMAT)
+            days = (end_date - start_date).days + 1
+            if days < 1:
+                raise ValueError(f"L'intervallo {spec} termina prima di iniziare.")
+            if days > MAX_BACKFILL_DAYS:
+                raise ValueError(f"L'intervallo {spec} è più lungo di {MAX_BACKFILL_DAYS} giorni.")
+            dates.extend((start_date + timedelta(days=i)).strftime(STORING_FORMAT) for i in range(days))
+        else:
+            dates.append(datetime.strptime(spec, DISPLAY_FORMAT).strftime(STORING_FORMAT))
+
+    if len(dates) > MAX_BACKFILL_DAYS:
+        raise ValueError(f"Puoi aggiornare al massimo {MAX_BACKFILL_DAYS} giorni alla volta.")
+
+    # Check all the dates at once
+    today = datetime.now(pytz.timezone('Europe/Rome')).strftime(STORING_FORMAT)
+    future_dates = sorted({date for date in dates if date > today})
+    if len(future_dates) == 1:
+        raise ValueError("La data selezionata è nel futuro.")
+    if future_dates:
+        raise ValueError(f"Le date {', '.join(datetime.strptime(date, STORING_FORMAT).strftime(DISPLAY_FORMAT) for date in future_dates)} sono nel futuro.")
+
+    return dates
+
+def split_message(lines):
+    """
+    Joins lines into as few messages as possible, each within the length limit of Telegram.
+
+    Args:
+        lines (list of str): Lines of the message, each shorter than MAX_MESSAGE_LENGTH.
+
+    Returns:
+        list of str: The messages to send, in order.
+    """
+    messages = []
+    current = ''
+    for line in lines:
+        candidate = f'{current}\n{line}' if current else line
+        # Telegram counts the UTF-16 code units, so an emoji counts twice
+        if current and len(candidate.encode('utf-16-le')) // 2 > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+def normalize_period_date(time_period, date):
+    """Normalize a 'month-year' date to 'MM-YYYY', leaving years untouched."""
+    if time_period == 'month':
+        month, year = date.split('-')
+        return f'{int(month):02}-{year}'
+    return date
+
+def get_chart_path(chat_id, time_period, date):
+    """Get the path of the chart image for the specified chat and time period."""
+    if time_period == 'month':
+        month, year = normalize_period_date(time_period, date).split('-')
+        saving_date = f'{year}_{month}'
+    else:
+        saving_date = date
+    return os.path.join(CHARTS_FOLDER, f'{chat_id}_{saving_date}.{CHART_FORMAT}')
+
 def generate_table_and_chart(rank, chat_id, time_period, date):
     """
     Generates the monthly ranking table and chart.
@@ -46,7 +141,6 @@ def generate_table_and_chart(rank, chat_id, time_period, date):
         year = int(date_parts[1])
         _, days = calendar.monthrange(year, month)
         period_label = calendar.month_name[month] + ' ' + str(year)
-        saving_date = str(date_parts[1]) + '_' + str(date_parts[0])
         steps = days
         x_labels = [str(day) for day in range(1, days + 1)]  # Labels for each day of the month
     elif time_period == 'year':
@@ -55,11 +149,10 @@ def generate_table_and_chart(rank, chat_id, time_period, date):
         days = 365 if calendar.isleap(year) else 366  # Number of days in a year
         steps = 12  # Number of months in a year
         period_label = str(year)
-        saving_date = date
         x_labels = [calendar.month_abbr[count_month] for count_month in range(1, steps + 1)]  # Labels for each month of the year
 
-    # Create the figure with the desired dimensions
-    fig = plt.figure(figsize=(15, 10))
+    # Create the figure with the desired dimensions (not tracked by pyplot, so it can be rendered from any thread)
+    fig = Figure(figsize=(15, 10))
     axes = fig.subplots(2, 1)
 
     # Generate the table
@@ -182,11 +275,66 @@ def generate_table_and_chart(rank, chat_id, time_period, date):
     # Set x-axis limits to include only the actual days of the month
     axes[1].set_xlim(left=1, right=days)
     
-    # Save the figure to an image file
-    plt.savefig(os.path.join(CHARTS_FOLDER, f'{chat_id}_{saving_date}.png'), bbox_inches='tight')
+    # Save the figure to an image file, lowering the resolution until it fits the size budget
+    path = get_chart_path(chat_id, time_period, date)
+    pil_kwargs = {'quality': 80, 'method': 6} if CHART_FORMAT == 'webp' else {'optimize': True}
+    dpi = CHART_DPI
+    while True:
+        fig.savefig(path, bbox_inches='tight', dpi=dpi, format=CHART_FORMAT, pil_kwargs=pil_kwargs)
+        if os.path.getsize(path) <= CHART_MAX_BYTES or dpi <= CHART_MIN_DPI:
+            break
+        dpi = max(CHART_MIN_DPI, int(dpi * 0.8))
+
+def precompute_period(chat_id, time_period, date):
+    """
+    Precomputes the ranking, the statistics and the chart of a chat for the specified time period.
+
+    Args:
+        chat_id (int): ID of the chat.
+        time_period (str): Time period ('month' or 'year').
+        date (str): Date in 'month-year' or 'year' format.
+
+    Returns:
+        None
+    """
+    date = normalize_period_date(time_period, date)
+    # Read the version before the queries, so that concurrent writes invalidate the result
+    version = get_period_version(chat_id, time_period, date)
+    rank = get_rank(chat_id, time_period, date)
+    statistics = get_statistics(chat_id, time_period, date)
+    chart = None
+    if rank:
+        generate_table_and_chart(rank, chat_id, time_period, date)
+        chart = get_chart_path(chat_id, time_period, date)
+
+    _precomputed[(chat_id, time_period, date)] = {
+        'version': version,
+        'rank': rank,
+        'statistics': statistics,
+        'chart': chart
+    }
+
+def get_precomputed(chat_id, time_period, date):
+    """
+    Gets the precomputed artifacts of a chat for the specified time period.
 
-    # Close figure
-    plt.close(fig)
+    Args:
+        chat_id (int): ID of the chat.
+        time_period (str): Time period ('month' or 'year').
+        date (str): Date in 'month-year' or 'year' format.
+
+    Returns:
+        dict or None: The 'rank', 'statistics' and 'chart' of the period, 
+        or None if they were never precomputed or the counts of the period changed since.
+    """
+    try:
+        date = normalize_period_date(time_period, date)
+    except ValueError:
+        return None
+    artifacts = _precomputed.get((chat_id, time_period, date))
+    if artifacts is None or artifacts['version'] != get_period_version(chat_id, time_period, date):
+        return None
+    return artifacts
 
 def analyze_user_record(rows):
     """